@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -164,3 +165,107 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.BrowsableAPIRenderer',
     ],
 }
+
+# Chat long-polling
+# Parked polls only avoid holding a worker thread when served through ASGI
+# (asgi.py); under WSGI each one holds a thread for its whole timeout.
+# Seconds a poll_messages request may stay parked waiting for new messages
+CHAT_LONG_POLL_TIMEOUT = int(os.getenv('CHAT_LONG_POLL_TIMEOUT', '25'))
+CHAT_LONG_POLL_MAX_TIMEOUT = 60
+# Maximum messages returned per room in one response
+CHAT_LONG_POLL_BATCH_SIZE = 100
+
+# Chat delta sync
+# Maximum new or edited messages returned per conversation by sync_conversations
+CHAT_SYNC_BATCH_SIZE = 200
+
+# Chat flood control
+# Token buckets per author (by role in the room) and per room, as DRF-style
+# rates. BACKEND is 'local' (per process) or 'cache' (shared via CACHES).
+CHAT_FLOOD_CONTROL = {
+    'BACKEND': os.getenv('CHAT_FLOOD_CONTROL_BACKEND', 'local'),
+    'USER_RATES': {
+        'admin': '120/min',
+        'moderator': '60/min',
+        'member': '20/min',
+    },
+    'ROOM_RATE': '300/min',
+}
+
+# Chat batched deletion (see chat/purge.py)
+CHAT_DELETION_BATCH_SIZE = 500
+# Seconds to sleep between batches so other writers get the tables
+CHAT_DELETION_PAUSE = 0.2
+# Seconds without progress after which a running job is taken to have lost
+# its worker and may be claimed by another; keep well above one batch
+CHAT_DELETION_STALE_AFTER = 600
+
+# Chat message compression (see chat/fields.py)
+# Message content at least this many characters long is stored zlib-compressed
+CHAT_COMPRESS_THRESHOLD = 1024
+CHAT_COMPRESS_LEVEL = 6
+
+# Chat group sharding (see chat/sharding.py)
+# CHAT_SHARD_DATABASE_URLS is a comma separated list of database URLs, one per
+# shard. CHAT_SHARDS=N instead adds N local SQLite files, for development.
+# Run `manage.py migrate --database shard_<n>` for every shard.
+CHAT_GROUP_SHARDS = []
+if os.getenv('CHAT_SHARD_DATABASE_URLS'):
+    for number, url in enumerate(os.getenv('CHAT_SHARD_DATABASE_URLS').split(','), start=1):
+        DATABASES[f'shard_{number}'] = dj_database_url.parse(url)
+        CHAT_GROUP_SHARDS.append(f'shard_{number}')
+elif os.getenv('CHAT_SHARDS'):
+    for number in range(1, int(os.getenv('CHAT_SHARDS')) + 1):
+        DATABASES[f'shard_{number}'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / f'db_shard_{number}.sqlite3',
+        }
+        CHAT_GROUP_SHARDS.append(f'shard_{number}')
+# Primary keys reserved per round trip to the shared id sequence. Above 1, ids
+# are only time ordered within a process and poll/sync cursors can skip
+# messages; see allocate_id.
+CHAT_SHARD_ID_BLOCK = 1
+
+DATABASE_ROUTERS = ['chat.sharding.GroupShardRouter']
+
+# Chat group statistics (see chat/stats.py)
+# Hourly activity older than this is pruned by rebuild_group_stats
+CHAT_ACTIVITY_RETENTION_DAYS = 30
+# Window the directory's "trending" sort counts messages over
+CHAT_TRENDING_HOURS = 24
+CHAT_DIRECTORY_PAGE_SIZE = 50
+CHAT_DIRECTORY_MAX_PAGE_SIZE = 200
+
+# Chat metrics (see chat/metrics.py)
+# Directory where each worker process writes its totals so the metrics
+# endpoint can add them up; unset reports only the process that answers.
+# Files of exited workers are folded into retired.json there.
+CHAT_METRICS_DIR = os.getenv('CHAT_METRICS_DIR')
+CHAT_METRICS_FLUSH_INTERVAL = 5
+# Bearer token the scraper sends to the metrics endpoint; staff users may also read it
+CHAT_METRICS_TOKEN = os.getenv('CHAT_METRICS_TOKEN')
+CHAT_METRICS_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Chat @mentions (see chat/mentions.py)
+# Mentions past this many in one message are ignored
+CHAT_MENTIONS_MAX_PER_MESSAGE = 20
+CHAT_MENTIONS_PAGE_SIZE = 50
+CHAT_MENTIONS_MAX_PAGE_SIZE = 200
+
+# Chat Markdown rendering (see chat/rendering.py)
+# Messages whose stored HTML is stale are rendered on read through an LRU of this many entries
+CHAT_RENDER_CACHE_SIZE = 2048
+
+# Chat profile cache (see chat/profiles.py)
+# Alias in CACHES; point it at a shared cache when running several workers
+CHAT_PROFILE_CACHE = 'default'
+CHAT_PROFILE_CACHE_TIMEOUT = 60 * 60
+CHAT_RESOLVE_MAX_IDS = 200
+
+# Chat attachment downloads (see chat/downloads.py)
+# None streams files from Django (with sendfile under gunicorn/uWSGI);
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd) hands them
+# to the front proxy instead
+CHAT_DOWNLOAD_OFFLOAD = os.getenv('CHAT_DOWNLOAD_OFFLOAD') or None
+# nginx `internal` location aliased to MEDIA_ROOT
+CHAT_DOWNLOAD_ACCEL_PREFIX = '/protected-media/'
@@ -3,6 +3,11 @@ WSGI config for SOFT806_WK3_Chatroom project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
 
+Under WSGI every parked long-poll (chat.views.poll_messages) holds a worker
+thread for up to CHAT_LONG_POLL_MAX_TIMEOUT seconds. To keep thousands of
+polls parked, serve asgi.py with an ASGI server instead, for example
+``uvicorn SOFT806_WK3_Chatroom.asgi:application``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/wsgi/
 """
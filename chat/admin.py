@@ -2,8 +2,9 @@ from django.contrib import admin
 from .models import (
     UserProfile, PublicChatHistory, PrivateMessage, 
     GroupChatroom, GroupChatroomMember, GroupMessage,
-    ChatFile, ChatImage
+    ChatFile, ChatImage, RetentionPolicy, DeletionJob, GroupStats, Mention
 )
+from .purge import schedule_user_deletion
 
 
 @admin.register(UserProfile)
@@ -12,6 +13,13 @@ class UserProfileAdmin(admin.ModelAdmin):
     list_filter = ['status', 'is_active', 'created_at']
     search_fields = ['username', 'display_name']
     readonly_fields = ['created_at', 'updated_at']
+    actions = ['schedule_deletion']
+    
+    @admin.action(description='Deactivate and schedule batched deletion')
+    def schedule_deletion(self, request, queryset):
+        for user in queryset:
+            schedule_user_deletion(user)
+        self.message_user(request, f"Scheduled {queryset.count()} users for deletion by process_deletions")
 
 
 @admin.register(PublicChatHistory)
@@ -44,10 +52,16 @@ class GroupChatroomAdmin(admin.ModelAdmin):
     list_filter = ['is_active', 'is_private', 'created_at']
     search_fields = ['created_by__username', 'created_by__display_name', 'name', 'description']
     readonly_fields = ['created_at']
+    list_select_related = ['created_by', 'stats']
     
     def member_count(self, obj):
-        return obj.members.filter(is_active=True).count()
+        # From the GroupStats rollup rather than a COUNT per row
+        try:
+            return obj.stats.member_count
+        except GroupStats.DoesNotExist:
+            return 0
     member_count.short_description = 'Active Members'
+    member_count.admin_order_field = 'stats__member_count'
 
 
 @admin.register(GroupChatroomMember)
@@ -84,3 +98,34 @@ class ChatImageAdmin(admin.ModelAdmin):
     list_filter = ['uploaded_at']
     search_fields = ['original_name', 'uploaded_by__username', 'uploaded_by__display_name']
     readonly_fields = ['uploaded_at', 'file_size', 'width', 'height']
+
+
+
+@admin.register(RetentionPolicy)
+class RetentionPolicyAdmin(admin.ModelAdmin):
+    list_display = ['room', 'max_age_days', 'is_active', 'created_at']
+    list_filter = ['is_active']
+    search_fields = ['room']
+
+
+@admin.register(DeletionJob)
+class DeletionJobAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'user_id', 'room', 'status', 'stage', 'rows_deleted', 'created_at', 'finished_at']
+    list_filter = ['kind', 'status']
+    readonly_fields = ['stage', 'rows_deleted', 'error', 'created_at', 'updated_at', 'finished_at']
+
+
+@admin.register(GroupStats)
+class GroupStatsAdmin(admin.ModelAdmin):
+    list_display = ['group', 'message_count', 'member_count', 'last_message_at']
+    list_select_related = ['group']
+    search_fields = ['group__name']
+    readonly_fields = ['message_count', 'member_count', 'last_message_id', 'last_message_at']
+
+
+@admin.register(Mention)
+class MentionAdmin(admin.ModelAdmin):
+    list_display = ['user', 'group', 'public_message', 'group_message', 'created_at', 'is_read']
+    list_filter = ['is_read', 'created_at']
+    search_fields = ['user__username', 'user__display_name']
+    raw_id_fields = ['user', 'public_message', 'group', 'group_message']
@@ -0,0 +1,192 @@
+"""
+Addressing conversations (rooms) by a short string key.
+
+Keys are ``public``, ``group:<group_id>`` and ``private:<other_user_id>``.
+A private key is always relative to the requesting user.
+"""
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+
+from .models import (
+    UserProfile, PublicChatHistory, PrivateMessage,
+    GroupChatroomMember, GroupMessage
+)
+from .sharding import for_group, group_databases
+from .serializers import (
+    PublicChatHistorySerializer, PrivateMessageSerializer, GroupMessageSerializer
+)
+
+
+class InvalidConversation(ValueError):
+    """Raised for a malformed conversation key"""
+
+
+class Conversation:
+    """A single room as seen by one user"""
+
+    def __init__(self, kind, target_id=None):
+        self.kind = kind
+        self.target_id = target_id
+
+    @classmethod
+    def parse(cls, key):
+        kind, _, target = key.partition(':')
+        if kind == 'public' and not target:
+            return cls('public')
+        if kind in ('group', 'private') and target.isdigit():
+            return cls(kind, int(target))
+        raise InvalidConversation(f"Invalid conversation '{key}'")
+
+    @property
+    def key(self):
+        if self.kind == 'public':
+            return 'public'
+        return f'{self.kind}:{self.target_id}'
+
+    def channel(self, user):
+        """Notification channel shared by every participant of this room"""
+        if self.kind == 'private':
+            return private_channel(user.pk, self.target_id)
+        return self.key
+
+    def messages(self, user):
+        if self.kind == 'public':
+            return PublicChatHistory.objects.all()
+        if self.kind == 'group':
+            return for_group(GroupMessage, self.target_id)
+        return PrivateMessage.objects.filter(
+            Q(sender=user, receiver_id=self.target_id) |
+            Q(sender_id=self.target_id, receiver=user)
+        )
+
+    def with_authors(self, queryset):
+        # Group messages may sit on a shard without the user table
+        if self.kind == 'group':
+            return queryset.prefetch_related('author')
+        return queryset.select_related('sender' if self.kind == 'private' else 'author')
+
+    def messages_after(self, user, after_id, authors=True):
+        """Messages newer than ``after_id``, oldest first"""
+        queryset = self.messages(user).filter(id__gt=after_id).order_by('id')
+        return self.with_authors(queryset) if authors else queryset
+
+    def save_kwargs(self, user):
+        """Fields that place a new message written by ``user`` in this room"""
+        if self.kind == 'group':
+            return {'author': user, 'group_id': self.target_id}
+        if self.kind == 'private':
+            return {'sender': user, 'receiver_id': self.target_id}
+        return {'author': user}
+
+    def edited_since(self, user, since, up_to_id, after_id=None, authors=True):
+        """
+        Already-seen messages (id <= ``up_to_id``) edited after ``since``, in
+        edit order. ``after_id`` continues a page that ended at an edit made
+        exactly at ``since``.
+        """
+        edited = Q(edited_at__gt=since)
+        if after_id is not None:
+            edited |= Q(edited_at=since, id__gt=after_id)
+        queryset = self.messages(user).filter(edited, id__lte=up_to_id).order_by('edited_at', 'id')
+        return self.with_authors(queryset) if authors else queryset
+
+    def membership_changes(self, since):
+        """Group members who joined, left or changed role after ``since``"""
+        if self.kind != 'group':
+            return GroupChatroomMember.objects.none()
+        return for_group(GroupChatroomMember, self.target_id).filter(
+            updated_at__gt=since
+        ).prefetch_related('user').order_by('updated_at')
+
+    @property
+    def serializer_class(self):
+        return {
+            'public': PublicChatHistorySerializer,
+            'private': PrivateMessageSerializer,
+            'group': GroupMessageSerializer,
+        }[self.kind]
+
+    def __repr__(self):
+        return f'<Conversation {self.key}>'
+
+
+def private_channel(user_id, other_id):
+    low, high = sorted((user_id, other_id))
+    return f'private:{low}:{high}'
+
+
+def channel_for_message(message):
+    """Notification channel a newly written message belongs to"""
+    if isinstance(message, GroupMessage):
+        return f'group:{message.group_id}'
+    if isinstance(message, PrivateMessage):
+        return private_channel(message.sender_id, message.receiver_id)
+    return 'public'
+
+
+def resolve_conversations(user, keys):
+    """
+    Parse ``keys`` and check that ``user`` may read every one of them.
+
+    Returns a dict of key -> Conversation. Raises InvalidConversation for a
+    bad key and PermissionDenied for a room the user cannot see.
+    """
+    conversations, unavailable = available_conversations(user, keys)
+    if unavailable:
+        raise next(iter(unavailable.values()))
+    return conversations
+
+
+def available_conversations(user, keys):
+    """
+    Like resolve_conversations, but rooms the user cannot read are returned
+    instead of raised: (key -> Conversation, key -> PermissionDenied or
+    InvalidConversation). Malformed keys still raise InvalidConversation.
+    """
+    conversations = {}
+    for key in keys:
+        conversation = Conversation.parse(key)
+        conversations[conversation.key] = conversation
+    unavailable = {}
+
+    group_ids = {c.target_id for c in conversations.values() if c.kind == 'group'}
+    if group_ids:
+        allowed = set()
+        for database, ids in group_databases(group_ids).items():
+            allowed.update(GroupChatroomMember.objects.using(database).filter(
+                user=user, is_active=True, group_id__in=ids
+            ).values_list('group_id', flat=True))
+        for group_id in group_ids - allowed:
+            unavailable[f'group:{group_id}'] = PermissionDenied('Not a member of this group')
+
+    user_ids = {c.target_id for c in conversations.values() if c.kind == 'private'}
+    if user.pk in user_ids:
+        unavailable[f'private:{user.pk}'] = InvalidConversation('Cannot open a private conversation with yourself')
+        user_ids.discard(user.pk)
+    if user_ids:
+        found = set(UserProfile.objects.filter(pk__in=user_ids, is_active=True).values_list('pk', flat=True))
+        for user_id in user_ids - found:
+            unavailable[f'private:{user_id}'] = InvalidConversation('Unknown user')
+
+    for key in unavailable:
+        del conversations[key]
+    return conversations, unavailable
+
+
+def conversation_role(user, conversation):
+    """
+    Role of ``user`` in a room they want to write to: their group role, or
+    ``admin`` for staff and ``member`` for everyone else outside groups.
+
+    Raises PermissionDenied or InvalidConversation like resolve_conversations.
+    """
+    if conversation.kind == 'group':
+        role = for_group(GroupChatroomMember, conversation.target_id).filter(
+            user=user, is_active=True
+        ).values_list('role', flat=True).first()
+        if role is None:
+            raise PermissionDenied('Not a member of this group')
+        return role
+    if conversation.kind == 'private':
+        resolve_conversations(user, [conversation.key])
+    return 'admin' if user.is_staff else 'member'
@@ -0,0 +1,199 @@
+"""
+Access-checked downloads of ChatFile and ChatImage attachments.
+
+Attachments are immutable once uploaded, so every response carries a strong
+ETag built from the row id, size and modification time, and may be cached
+by the browser for a year. Conditional requests (If-None-Match) and single
+byte ranges (Range, If-Range) are answered here.
+
+Only PNG, JPEG, GIF and WebP images, recognised from the stored bytes, are
+shown inline; anything else, whatever its name, is sent as an attachment,
+and every response is sandboxed by its Content-Security-Policy, so an
+uploaded SVG or HTML page never runs on the API's origin.
+
+The bytes themselves are moved by whatever is cheapest:
+
+* CHAT_DOWNLOAD_OFFLOAD = 'x-accel-redirect' or 'x-sendfile' hands the file
+  to the front proxy (nginx internal location CHAT_DOWNLOAD_ACCEL_PREFIX
+  mapped onto MEDIA_ROOT, or Apache/lighttpd mod_xsendfile), which then
+  also handles ranges itself;
+* otherwise a FileResponse lets a WSGI server with wsgi.file_wrapper
+  (gunicorn, uWSGI) send it with sendfile(), ranges included, and only
+  falls back to reading in Python under ASGI or runserver.
+"""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
+from django.utils.http import content_disposition_header, http_date
+
+from .models import ChatFile, ChatImage, GroupChatroomMember
+from .sharding import find_by_pk, for_group
+
+
+MODELS = {'file': ChatFile, 'image': ChatImage}
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Leading bytes of the image types safe to display inline
+INLINE_IMAGE_TYPES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class RangeFile:
+    """A file limited to ``length`` bytes from its current position"""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        # For sendfile(): the WSGI server starts at the current offset and
+        # stops after Content-Length bytes
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def find_attachment(kind, pk):
+    """The attachment, from whichever database holds it"""
+    return find_by_pk(MODELS[kind], pk)
+
+
+def can_access(user, attachment):
+    """Uploader, staff, and whoever can read the message it was shared in"""
+    if user.is_staff or attachment.uploaded_by_id == user.pk:
+        return True
+    try:
+        if attachment.public_message_id:
+            return True
+        if attachment.private_message_id:
+            message = attachment.private_message
+            return user.pk in (message.sender_id, message.receiver_id)
+        if attachment.group_message_id:
+            return for_group(GroupChatroomMember, attachment.group_message.group_id).filter(
+                user=user, is_active=True
+            ).exists()
+    except ObjectDoesNotExist:
+        # The message is gone but the link was not cleared
+        pass
+    return False
+
+
+def parse_range(header, size):
+    """(start, end) inclusive for a single satisfiable range, None to send it all, or ValueError"""
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        # Malformed and multi-range requests get the whole file
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+def inline_image_type(path):
+    """Content type of a raster image that can be shown inline, else None"""
+    with open(path, 'rb') as file:
+        head = file.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in INLINE_IMAGE_TYPES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+def _etag_matches(header, etag):
+    return header.strip() == '*' or etag in (tag.strip() for tag in header.split(','))
+
+
+def serve(request, attachment):
+    field = attachment.image if isinstance(attachment, ChatImage) else attachment.file
+    try:
+        path = field.path
+    except NotImplementedError:
+        # Remote storage: let it serve the file
+        return HttpResponseRedirect(field.url)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return HttpResponse(status=404)
+
+    etag = f'"{attachment._meta.model_name}-{attachment.pk:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': CACHE_CONTROL,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Content-Security-Policy': 'sandbox',
+    }
+    if _etag_matches(request.headers.get('If-None-Match', ''), etag):
+        return HttpResponse(status=304, headers=headers)
+
+    image_type = inline_image_type(path) if isinstance(attachment, ChatImage) else None
+    if image_type:
+        content_type = image_type
+        as_attachment = False
+    elif isinstance(attachment, ChatImage):
+        content_type = 'application/octet-stream'
+        as_attachment = True
+    else:
+        content_type = attachment.file_type or 'application/octet-stream'
+        as_attachment = True
+
+    offload = settings.CHAT_DOWNLOAD_OFFLOAD
+    if offload:
+        response = HttpResponse(content_type=content_type, headers=headers)
+        if offload == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = settings.CHAT_DOWNLOAD_ACCEL_PREFIX + quote(field.name)
+        else:
+            response['X-Sendfile'] = path
+        response['Content-Disposition'] = content_disposition_header(as_attachment, attachment.original_name)
+        return response
+
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if range_header and (
+        'If-Range' not in request.headers or request.headers['If-Range'].strip() == etag
+    ):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except ValueError:
+            return HttpResponse(status=416, headers={**headers, 'Content-Range': f'bytes */{stat.st_size}'})
+
+    file = open(path, 'rb')
+    if byte_range is None:
+        return FileResponse(file, content_type=content_type, as_attachment=as_attachment,
+                            filename=attachment.original_name, headers=headers)
+
+    start, end = byte_range
+    file.seek(start)
+    response = FileResponse(RangeFile(file, end - start + 1), status=206, content_type=content_type,
+                            as_attachment=as_attachment, filename=attachment.original_name, headers=headers)
+    response['Content-Length'] = end - start + 1
+    response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    return response
@@ -0,0 +1,129 @@
+"""
+Streaming NDJSON export of chat history.
+
+Rows are read in keyset batches (``id > last id ORDER BY id LIMIT n``), so no
+query holds a long-running cursor and memory stays flat however large the
+history is. Each batch is written out as soon as it is read.
+"""
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .conversations import Conversation, InvalidConversation
+from .models import PublicChatHistory, PrivateMessage, GroupMessage
+from .sharding import fan_out, for_group
+
+
+BATCH_SIZE = 2000
+
+
+def _attachments(message):
+    return {
+        'files': [{
+            'id': f.id,
+            'name': f.original_name,
+            'size': f.file_size,
+            'type': f.file_type,
+            'path': f.file.name,
+            'uploaded_at': f.uploaded_at,
+        } for f in message.files.all()],
+        'images': [{
+            'id': i.id,
+            'name': i.original_name,
+            'size': i.file_size,
+            'width': i.width,
+            'height': i.height,
+            'path': i.image.name,
+            'uploaded_at': i.uploaded_at,
+        } for i in message.images.all()],
+    }
+
+
+def _record(kind, message):
+    record = {
+        'type': kind,
+        'id': message.id,
+        'content': message.content,
+        'timestamp': message.timestamp,
+        'edited': message.edited,
+        'edited_at': message.edited_at,
+        'message_type': message.message_type,
+        'reply_to': message.reply_to_id,
+    }
+    if kind == 'private':
+        record.update(sender=message.sender_id, receiver=message.receiver_id,
+                      is_read=message.is_read, read_at=message.read_at)
+    else:
+        record['author'] = message.author_id
+    if kind == 'group':
+        record['group'] = message.group_id
+    record.update(_attachments(message))
+    return record
+
+
+def _keyset_batches(queryset, batch_size):
+    queryset = queryset.prefetch_related('files', 'images').order_by('id')
+    last_id = 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
+
+
+def _sources_for_user(user_id):
+    return [
+        ('public', PublicChatHistory.objects.filter(author_id=user_id)),
+        ('private', PrivateMessage.objects.filter(sender_id=user_id)),
+        ('private', PrivateMessage.objects.filter(receiver_id=user_id)),
+    ] + [
+        ('group', queryset) for queryset in fan_out(GroupMessage.objects.filter(author_id=user_id))
+    ]
+
+
+def _sources_for_room(key):
+    conversation = Conversation.parse(key)
+    if conversation.kind == 'public':
+        return [('public', PublicChatHistory.objects.all())]
+    if conversation.kind == 'group':
+        return [('group', for_group(GroupMessage, conversation.target_id))]
+    raise InvalidConversation('Private conversations are exported per user')
+
+
+def export_lines(user_id=None, room=None, batch_size=BATCH_SIZE):
+    """
+    Yield the export as text chunks, one per batch, each holding one JSON
+    object per line. Exactly one of ``user_id`` and ``room`` is required.
+    """
+    sources = _sources_for_user(user_id) if user_id is not None else _sources_for_room(room)
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    for kind, queryset in sources:
+        for batch in _keyset_batches(queryset, batch_size):
+            yield ''.join(encoder.encode(_record(kind, message)) + '\n' for message in batch)
+
+
+def gzip_chunks(chunks):
+    """Compress a stream of text chunks into a gzip stream"""
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(user_id=None, room=None, compress=False, batch_size=BATCH_SIZE):
+    """Bytes of the NDJSON export, optionally gzipped"""
+    chunks = export_lines(user_id=user_id, room=room, batch_size=batch_size)
+    if compress:
+        return gzip_chunks(chunks)
+    return (chunk.encode('utf-8') for chunk in chunks)
+
+
+def validate_export_target(user_id=None, room=None):
+    """Raise InvalidConversation unless exactly one valid target is given"""
+    if (user_id is None) == (room is None):
+        raise InvalidConversation('Give either a user or a room to export')
+    if room is not None:
+        _sources_for_room(room)
@@ -0,0 +1,107 @@
+"""
+CompressedTextField: a TextField that stores large values zlib-compressed.
+
+The column stays an ordinary text column. Values of at least
+CHAT_COMPRESS_THRESHOLD characters are stored as a two character header
+(MARKER plus a codec flag) followed by the base85 encoded zlib stream, but
+only when that actually comes out smaller. Anything without the header is
+plain text, so rows written before the field existed read back unchanged
+and can be rewritten later with the compress_messages command.
+
+Values are decompressed lazily: loading a row keeps the stored form and the
+model attribute unpacks it on first access. ``.values()`` and
+``.values_list()`` bypass model attributes and return PackedText objects
+for compressed rows; use ``str()`` on them. Database-side lookups such as
+``content__icontains`` only see the stored form of compressed rows.
+"""
+import base64
+import zlib
+
+from django.conf import settings
+from django.db import models
+from django.db.models.query_utils import DeferredAttribute
+
+
+MARKER = '\x01'
+PLAIN = 'p'
+ZLIB = 'z'
+
+
+def pack(text, threshold=None, level=None):
+    """Stored form of ``text``"""
+    threshold = settings.CHAT_COMPRESS_THRESHOLD if threshold is None else threshold
+    if len(text) >= threshold:
+        raw = text.encode('utf-8')
+        level = settings.CHAT_COMPRESS_LEVEL if level is None else level
+        encoded = base64.b85encode(zlib.compress(raw, level)).decode('ascii')
+        if len(encoded) + 2 < len(raw):
+            return MARKER + ZLIB + encoded
+    if text.startswith(MARKER):
+        # Escape so user text can never be mistaken for a header
+        return MARKER + PLAIN + text
+    return text
+
+
+def unpack(stored):
+    """Original text of a stored value"""
+    if not stored.startswith(MARKER):
+        return stored
+    flag, payload = stored[1:2], stored[2:]
+    if flag == ZLIB:
+        return zlib.decompress(base64.b85decode(payload)).decode('utf-8')
+    if flag == PLAIN:
+        return payload
+    raise ValueError(f'Unknown compressed text flag {flag!r}')
+
+
+class PackedText:
+    """A stored value that has not been decompressed yet"""
+    __slots__ = ('stored',)
+
+    def __init__(self, stored):
+        self.stored = stored
+
+    def unpack(self):
+        return unpack(self.stored)
+
+    def __str__(self):
+        return self.unpack()
+
+    def __repr__(self):
+        return f'<PackedText {len(self.stored)} chars>'
+
+
+class CompressedTextDescriptor(DeferredAttribute):
+    """Unpacks the stored value on first attribute access and caches the result"""
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        if isinstance(value, PackedText):
+            value = instance.__dict__[self.field.attname] = value.unpack()
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class CompressedTextField(models.TextField):
+    descriptor_class = CompressedTextDescriptor
+
+    def from_db_value(self, value, expression, connection):
+        if value is None or not value.startswith(MARKER):
+            return value
+        return PackedText(value)
+
+    def to_python(self, value):
+        if isinstance(value, PackedText):
+            return value.unpack()
+        return super().to_python(value)
+
+    def get_db_prep_save(self, value, connection):
+        # Only values being written are packed; lookup arguments are left alone
+        value = super().get_db_prep_save(value, connection)
+        if value is None:
+            return value
+        return pack(value)
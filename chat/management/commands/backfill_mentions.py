@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.mentions import MIGHT_MENTION, mentions_for_messages
+from chat.models import PublicChatHistory, GroupMessage, Mention
+from chat.sharding import fan_out
+
+
+class Command(BaseCommand):
+    help = (
+        'Parse @mentions out of existing public and group messages in batches. '
+        'Safe to rerun: mentions that already exist are left alone.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        sources = [('public', PublicChatHistory.objects.all())] + [
+            (f'group@{queryset.db}', queryset) for queryset in fan_out(GroupMessage.objects.all())
+        ]
+        total = 0
+        for name, queryset in sources:
+            found = self.backfill(queryset, options['batch_size'], options['pause'])
+            total += found
+            self.stdout.write(f'  {name}: {found} mentions')
+        self.stdout.write(self.style.SUCCESS(f'Found {total} mentions; any already stored were skipped'))
+
+    def backfill(self, queryset, batch_size, pause):
+        queryset = queryset.filter(MIGHT_MENTION).only(
+            'pk', 'content', 'author', 'timestamp', *(['group'] if queryset.model is GroupMessage else [])
+        ).order_by('pk')
+        found = 0
+        last_pk = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return found
+            last_pk = batch[-1].pk
+            mentions = mentions_for_messages(batch)
+            Mention.objects.bulk_create(mentions, ignore_conflicts=True)
+            found += len(mentions)
+            if pause:
+                time.sleep(pause)
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.urls import resolve
+
+from chat.metrics import MetricsMiddleware
+
+
+class Command(BaseCommand):
+    help = 'Measure what MetricsMiddleware adds to each request, against a view that does nothing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        request = RequestFactory().post('/api/chat/messages/public/', data='{"content": "hi"}',
+                                        content_type='application/json')
+        request.resolver_match = resolve(request.path)
+        response = HttpResponse(b'{"id": 1}', content_type='application/json')
+
+        def view(request):
+            return response
+
+        bare = self.time(view, request, count)
+        measured = self.time(MetricsMiddleware(view), request, count)
+        self.stdout.write(f'{count} requests: {bare:.2f} us bare, {measured:.2f} us with metrics')
+        self.stdout.write(self.style.SUCCESS(f'Overhead: {measured - bare:.2f} us per request'))
+
+    def time(self, handler, request, count):
+        start = time.perf_counter()
+        for _ in range(count):
+            handler(request)
+        return (time.perf_counter() - start) / count * 1e6
@@ -0,0 +1,120 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Length
+
+from chat.fields import MARKER, ZLIB, pack, unpack
+from chat.models import PublicChatHistory, PrivateMessage, GroupMessage
+from chat.sharding import fan_out
+
+
+SAMPLE_LINE = '2026-10-19 10:15:02,331 WARNING [worker-7] retrying request id=8f3a2c after timeout (attempt 3/5)\n'
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewrite existing message content in batches so values above '
+        'CHAT_COMPRESS_THRESHOLD are stored compressed, and report bytes saved'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be saved')
+        parser.add_argument('--benchmark', type=int, metavar='N', default=0,
+                            help='Also time compression and decompression on up to N stored messages')
+
+    def handle(self, *args, **options):
+        total_before = total_after = 0
+        for queryset in self.sources():
+            before, after, rows = self.compress(queryset, options['batch_size'], options['dry_run'])
+            total_before += before
+            total_after += after
+            self.stdout.write(
+                f'{queryset.model.__name__}@{queryset.db}: {rows} rows {"would be " if options["dry_run"] else ""}compressed, '
+                f'{before} -> {after} bytes'
+            )
+        saved = total_before - total_after
+        percent = 100 * saved / total_before if total_before else 0
+        self.stdout.write(self.style.SUCCESS(f'Saved {saved} bytes ({percent:.1f}%) on content above the threshold'))
+
+        if options['benchmark']:
+            self.benchmark(options['benchmark'])
+
+    def sources(self):
+        # Group messages live on their group's shard
+        return [PublicChatHistory.objects.all(), PrivateMessage.objects.all()] + fan_out(GroupMessage.objects.all())
+
+    def candidates(self, queryset):
+        return queryset.annotate(
+            content_length=Length('content')
+        ).filter(
+            content_length__gte=settings.CHAT_COMPRESS_THRESHOLD
+        ).exclude(content__startswith=MARKER).order_by('pk')
+
+    def compress(self, queryset, batch_size, dry_run):
+        before = after = rows = 0
+        candidates = self.candidates(queryset)
+        last_pk = 0
+        while True:
+            batch = list(candidates.filter(pk__gt=last_pk).values_list('pk', 'content')[:batch_size])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+            changed = []
+            for pk, text in batch:
+                packed = pack(text)
+                if packed == text:
+                    continue
+                before += len(text.encode('utf-8'))
+                after += len(packed.encode('utf-8'))
+                changed.append((pk, text))
+            rows += len(changed)
+            if changed and not dry_run:
+                with transaction.atomic(using=queryset.db):
+                    for pk, text in changed:
+                        # The field packs the value on save; update() skips signals
+                        queryset.filter(pk=pk).update(content=text)
+        return before, after, rows
+
+    def benchmark(self, limit):
+        samples = []
+        for queryset in self.sources():
+            for stored in queryset.annotate(
+                content_length=Length('content')
+            ).filter(
+                Q(content_length__gte=settings.CHAT_COMPRESS_THRESHOLD) |
+                Q(content__startswith=MARKER + ZLIB)
+            ).values_list('content', flat=True)[:limit - len(samples)]:
+                samples.append(str(stored))
+            if len(samples) >= limit:
+                break
+        if not samples:
+            self.stdout.write('No stored messages above the threshold; benchmarking a synthetic log paste')
+            samples = [SAMPLE_LINE * 40] * limit
+
+        packed = [pack(text) for text in samples]
+        raw_bytes = sum(len(text.encode('utf-8')) for text in samples)
+        packed_bytes = sum(len(value.encode('utf-8')) for value in packed)
+        rounds = max(1, 2000 // len(samples))
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for text in samples:
+                pack(text)
+        write_us = (time.perf_counter() - started) / (rounds * len(samples)) * 1e6
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for value in packed:
+                unpack(value)
+        read_us = (time.perf_counter() - started) / (rounds * len(samples)) * 1e6
+
+        self.stdout.write(
+            f'Benchmark over {len(samples)} messages averaging {raw_bytes // len(samples)} bytes:\n'
+            f'  size: {raw_bytes} -> {packed_bytes} bytes ({packed_bytes / raw_bytes:.2f}x)\n'
+            f'  write overhead (compress): {write_us:.1f} us/message\n'
+            f'  read overhead (decompress on first access): {read_us:.1f} us/message'
+        )
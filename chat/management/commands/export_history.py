@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.conversations import InvalidConversation
+from chat.exports import BATCH_SIZE, export_stream, validate_export_target
+
+
+class Command(BaseCommand):
+    help = 'Export the full history of a user or a room as NDJSON'
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument('--user', type=int, help='User id')
+        target.add_argument('--room', help='public or group:<id>')
+        parser.add_argument('-o', '--output', help='File to write; defaults to stdout')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            validate_export_target(user_id=options['user'], room=options['room'])
+        except InvalidConversation as e:
+            raise CommandError(str(e))
+
+        stream = export_stream(
+            user_id=options['user'], room=options['room'],
+            compress=options['gzip'], batch_size=options['batch_size']
+        )
+        if options['output']:
+            with open(options['output'], 'wb') as f:
+                for chunk in stream:
+                    f.write(chunk)
+        else:
+            for chunk in stream:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
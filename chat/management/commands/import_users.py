@@ -0,0 +1,124 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from chat.models import UserProfile
+
+
+FIELDS = ['username', 'email', 'password', 'display_name', 'first_name', 'last_name', 'bio']
+
+
+def _init_worker():
+    django.setup()
+
+
+def _hash_passwords(passwords):
+    # make_password(None) gives an unusable password, like set_unusable_password()
+    return [make_password(password or None) for password in passwords]
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk import users from a CSV or JSON file. Columns: username, email, password, '
+        'display_name, first_name, last_name, bio. Passwords are hashed in parallel and '
+        'are not run through AUTH_PASSWORD_VALIDATORS.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with a header row, or a JSON list of objects')
+        parser.add_argument('--format', choices=['csv', 'json'], help='Defaults to the file extension')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Password hashing processes')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per insert')
+        parser.add_argument('--no-tokens', action='store_true', help='Do not create API tokens')
+
+    def handle(self, *args, **options):
+        rows = self.read_rows(options['path'], options['format'])
+        rows = self.clean_rows(rows)
+        total = len(rows)
+        if not total:
+            self.stdout.write('Nothing to import')
+            return
+
+        batch_size = options['batch_size']
+        batches = list(_batches(rows, batch_size))
+        started = time.monotonic()
+        imported = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as executor:
+            hashed_batches = executor.map(
+                _hash_passwords, ([row['password'] for row in batch] for batch in batches)
+            )
+            for batch, hashes in zip(batches, hashed_batches):
+                self.insert_batch(batch, hashes, batch_size, tokens=not options['no_tokens'])
+                imported += len(batch)
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'Imported {imported}/{total} users ({imported / elapsed:.0f}/s)'
+                )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {imported} users in {time.monotonic() - started:.1f}s'
+        ))
+
+    def read_rows(self, path, format):
+        format = format or os.path.splitext(path)[1].lstrip('.').lower()
+        try:
+            with open(path, newline='', encoding='utf-8') as f:
+                if format == 'csv':
+                    return list(csv.DictReader(f))
+                if format == 'json':
+                    return json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not read {path}: {e}')
+        raise CommandError(f'Unknown format {format!r}; use --format csv or --format json')
+
+    def clean_rows(self, rows):
+        """Normalize rows and drop those without a username or clashing with existing users"""
+        cleaned = {}
+        for number, row in enumerate(rows, start=1):
+            username = UserProfile.normalize_username((row.get('username') or '').strip())
+            if not username:
+                self.stderr.write(f'Row {number}: missing username, skipped')
+                continue
+            if username in cleaned:
+                self.stderr.write(f'Row {number}: duplicate username {username!r}, skipped')
+                continue
+            cleaned[username] = {field: (row.get(field) or '') for field in FIELDS}
+            cleaned[username]['username'] = username
+            cleaned[username]['email'] = UserProfile.objects.normalize_email(cleaned[username]['email'])
+
+        existing = set()
+        for batch in _batches(cleaned, 10000):
+            existing.update(UserProfile.objects.filter(
+                username__in=batch
+            ).values_list('username', flat=True))
+        if existing:
+            self.stderr.write(f'Skipping {len(existing)} users that already exist')
+        return [row for username, row in cleaned.items() if username not in existing]
+
+    def insert_batch(self, rows, hashes, batch_size, tokens):
+        users = [
+            UserProfile(**{**row, 'password': password})
+            for row, password in zip(rows, hashes)
+        ]
+        with transaction.atomic():
+            users = UserProfile.objects.bulk_create(users, batch_size=batch_size)
+            if tokens:
+                Token.objects.bulk_create(
+                    [Token(key=Token.generate_key(), user=user) for user in users],
+                    batch_size=batch_size
+                )
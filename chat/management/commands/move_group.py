@@ -0,0 +1,141 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from chat import sharding
+from chat.models import GroupChatroom, GroupChatroomMember, GroupMessage, ChatFile, ChatImage, GroupShard
+
+
+class Command(BaseCommand):
+    help = (
+        "Move a group's messages, members and attachments to another database. "
+        'The group stays readable throughout; writes are refused only while '
+        'the changes made during the bulk copy are copied over.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_id', type=int)
+        parser.add_argument('database', help='Target database alias')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if not sharding.enabled():
+            raise CommandError('Sharding is not enabled (CHAT_GROUP_SHARDS is empty)')
+        target = options['database']
+        if target not in sharding.databases():
+            raise CommandError(f"Unknown database {target!r}; choose from {', '.join(sharding.databases())}")
+        group_id = options['group_id']
+        if not GroupChatroom.objects.filter(pk=group_id).exists():
+            raise CommandError(f'Group {group_id} does not exist')
+
+        self.batch_size = options['batch_size']
+        sharding.forget_route(group_id)
+        source = sharding.shard_for_group(group_id)
+        if source == target:
+            self.stdout.write(f'Group {group_id} is already on {target}')
+            return
+
+        started = timezone.now()
+        self.stdout.write(f'Copying group {group_id} from {source} to {target}')
+        self.copy(group_id, source, target)
+
+        self.stdout.write('Freezing writes while the remaining changes are copied')
+        self.set_route(group_id, source, is_moving=True)
+        self.wait_for_routes()
+        try:
+            self.copy(group_id, source, target, edited_since=started)
+            self.remove_deleted(group_id, source, target)
+        except Exception:
+            self.set_route(group_id, source, is_moving=False)
+            raise
+        self.set_route(group_id, target, is_moving=False)
+        self.stdout.write(f'Group {group_id} now lives on {target}; removing the old copy')
+
+        # Processes with a stale route keep reading the source until it expires
+        self.wait_for_routes()
+        self.delete_source(group_id, source)
+        self.stdout.write(self.style.SUCCESS(f'Moved group {group_id} to {target}'))
+
+    def set_route(self, group_id, database, is_moving):
+        GroupShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+            group_id=group_id, defaults={'database': database, 'is_moving': is_moving}
+        )
+        sharding.forget_route(group_id)
+
+    def wait_for_routes(self):
+        time.sleep(sharding.ROUTE_TTL + 1)
+
+    def querysets(self, group_id, database):
+        members = GroupChatroomMember.objects.using(database).filter(group_id=group_id)
+        messages = GroupMessage.objects.using(database).filter(group_id=group_id)
+        message_ids = messages.values('pk')
+        return [
+            ('members', members),
+            ('messages', messages),
+            ('files', ChatFile.objects.using(database).filter(group_message__in=message_ids)),
+            ('images', ChatImage.objects.using(database).filter(group_message__in=message_ids)),
+        ]
+
+    def copy(self, group_id, source, target, edited_since=None):
+        """
+        Upsert the group's rows from source into target. With ``edited_since``
+        only messages missing from target or edited since then are copied:
+        ids come from per-process blocks, so a message written during the
+        bulk copy can have a lower id than ones already copied.
+        """
+        targets = dict(self.querysets(group_id, target))
+        for name, queryset in self.querysets(group_id, source):
+            copied = 0
+            last_pk = 0
+            while True:
+                batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:self.batch_size])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                if name == 'messages' and edited_since is not None:
+                    present = set(targets[name].filter(pk__in=[obj.pk for obj in batch]).values_list('pk', flat=True))
+                    batch = [
+                        obj for obj in batch
+                        if obj.pk not in present or (obj.edited_at is not None and obj.edited_at >= edited_since)
+                    ]
+                with transaction.atomic(using=target):
+                    for obj in batch:
+                        # raw, like loaddata: keeps timestamps and ids, and signal handlers skip it
+                        obj.save_base(raw=True, using=target)
+                copied += len(batch)
+            self.stdout.write(f'  {name}: {copied} rows copied')
+
+    def remove_deleted(self, group_id, source, target):
+        """Drop rows from target that were deleted from source during the copy"""
+        sources = dict(self.querysets(group_id, source))
+        for name, queryset in reversed(self.querysets(group_id, target)):
+            last_pk = 0
+            while True:
+                pks = list(queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+                if not pks:
+                    break
+                last_pk = pks[-1]
+                kept = set(sources[name].filter(pk__in=pks).values_list('pk', flat=True))
+                gone = [pk for pk in pks if pk not in kept]
+                if not gone:
+                    continue
+                with transaction.atomic(using=target):
+                    if name == 'messages':
+                        queryset.filter(reply_to__in=gone).update(reply_to=None)
+                    queryset.model.objects.using(target).filter(pk__in=gone)._raw_delete(target)
+
+    def delete_source(self, group_id, source):
+        # Newest first so replies go before the messages they point at, and
+        # _raw_delete so no delete signals fire for rows that still exist
+        for name, queryset in reversed(self.querysets(group_id, source)):
+            deleted = 0
+            while True:
+                pks = list(queryset.order_by('-pk').values_list('pk', flat=True)[:self.batch_size])
+                if not pks:
+                    break
+                with transaction.atomic(using=source):
+                    queryset.model.objects.using(source).filter(pk__in=pks)._raw_delete(source)
+                deleted += len(pks)
+            self.stdout.write(f'  {name}: {deleted} rows removed from {source}')
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import DeletionJob
+from chat.purge import JobTaken, run_job, schedule_retention
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued user removals and retention purges in bounded batches. '
+        'Jobs are claimed first, so several workers can run at once; jobs '
+        'interrupted by a dead worker resume once CHAT_DELETION_STALE_AFTER has passed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', action='store_true', help='Queue purges for active retention policies first')
+        parser.add_argument('--batch-size', type=int, help='Rows per batch (CHAT_DELETION_BATCH_SIZE)')
+        parser.add_argument('--pause', type=float, help='Seconds between batches (CHAT_DELETION_PAUSE)')
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, checking for new jobs this often')
+
+    def handle(self, *args, **options):
+        while True:
+            if options['retention']:
+                for job in schedule_retention():
+                    self.stdout.write(f'Queued {job}')
+            failed = 0
+            for job in DeletionJob.objects.filter(status__in=['pending', 'running']):
+                try:
+                    run_job(job, batch_size=options['batch_size'], pause=options['pause'], log=self.stdout.write)
+                except JobTaken:
+                    continue
+                except Exception as e:
+                    # run_job has marked it failed; it is not picked up again until requeued
+                    failed += 1
+                    self.stderr.write(self.style.ERROR(f'{job} failed after {job.rows_deleted} rows: {e}'))
+                    continue
+                self.stdout.write(self.style.SUCCESS(f'{job}: {job.rows_deleted} rows deleted'))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+        if failed:
+            raise CommandError(f'{failed} deletion job(s) failed')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import UserProfile
+from chat.purge import JobTaken, run_job, schedule_user_deletion
+
+
+class Command(BaseCommand):
+    help = 'Deactivate a user and queue the batched deletion of all their data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_id', type=int)
+        parser.add_argument('--now', action='store_true', help='Process the job here instead of leaving it to process_deletions')
+
+    def handle(self, *args, **options):
+        try:
+            user = UserProfile.objects.get(pk=options['user_id'])
+        except UserProfile.DoesNotExist:
+            raise CommandError(f"User {options['user_id']} does not exist")
+
+        job = schedule_user_deletion(user)
+        self.stdout.write(f'Queued {job}')
+        if options['now']:
+            try:
+                run_job(job, log=self.stdout.write)
+            except JobTaken:
+                self.stdout.write(f'{job} is already being processed by another worker')
+                return
+            self.stdout.write(self.style.SUCCESS(f'{job}: {job.rows_deleted} rows deleted'))
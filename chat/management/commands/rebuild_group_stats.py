@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import GroupChatroom
+from chat.stats import prune_activity, rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute group statistics and hourly activity from the messages and '
+        'members themselves, and drop activity older than CHAT_ACTIVITY_RETENTION_DAYS. '
+        'Run it once after enabling stats and whenever the counters look off.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_ids', nargs='*', type=int, help='Only these groups (default: all)')
+        parser.add_argument('--days', type=int, help='Days of hourly activity to rebuild (CHAT_ACTIVITY_RETENTION_DAYS)')
+
+    def handle(self, *args, **options):
+        days = options['days'] or settings.CHAT_ACTIVITY_RETENTION_DAYS
+        since = timezone.now() - timedelta(days=days)
+        groups = GroupChatroom.objects.order_by('pk').values_list('pk', flat=True)
+        if options['group_ids']:
+            groups = groups.filter(pk__in=options['group_ids'])
+
+        rebuilt = 0
+        for group_id in groups.iterator():
+            rebuild(group_id, since=since)
+            rebuilt += 1
+        pruned = prune_activity()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt stats for {rebuilt} groups; pruned {pruned} old activity rows'))
@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from chat.models import PublicChatHistory, PrivateMessage, GroupMessage
+from chat.rendering import RENDER_VERSION, render
+from chat.sharding import fan_out
+
+
+# Rows whose stored HTML is missing, from an older renderer, or older than an edit
+STALE = (
+    Q(render_version__lt=RENDER_VERSION) | Q(rendered_at__isnull=True) |
+    Q(edited_at__gt=F('rendered_at'))
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Render the Markdown of messages whose stored HTML is missing, stale after '
+        'an edit, or from an older renderer, in batches. Run it after bumping '
+        'RENDER_VERSION, or with --loop to keep up with edits made outside save().'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches')
+        parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running, checking for stale rows this often')
+
+    def handle(self, *args, **options):
+        while True:
+            sources = [PublicChatHistory.objects.all(), PrivateMessage.objects.all()] + fan_out(GroupMessage.objects.all())
+            for queryset in sources:
+                rendered = self.rerender(queryset, options['batch_size'], options['pause'])
+                if rendered or not options['loop']:
+                    self.stdout.write(f'{queryset.model.__name__}@{queryset.db}: {rendered} rendered')
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
+
+    def rerender(self, queryset, batch_size, pause):
+        stale = queryset.filter(STALE).order_by('pk')
+        rendered = 0
+        last_pk = 0
+        while True:
+            batch = list(stale.filter(pk__gt=last_pk).values_list('pk', 'content', 'edited_at')[:batch_size])
+            if not batch:
+                return rendered
+            last_pk = batch[-1][0]
+            updates = [(pk, edited_at, render(str(content))) for pk, content, edited_at in batch]
+            with transaction.atomic(using=queryset.db):
+                for pk, edited_at, html in updates:
+                    # Skips rows edited since they were read; their save() rendered them already.
+                    # update() runs no signals and the field packs the HTML.
+                    rendered += queryset.filter(pk=pk, edited_at=edited_at).update(
+                        content_html=html, render_version=RENDER_VERSION, rendered_at=timezone.now()
+                    )
+            if pause:
+                time.sleep(pause)
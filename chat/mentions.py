@@ -0,0 +1,130 @@
+"""
+@mentions, parsed once when a message is written.
+
+Creating a PublicChatHistory or GroupMessage row, or saving one whose
+content changed, parses the content and brings its Mention rows in line, so
+edits add and remove mentions. A
+mention resolves to an active user by exact username; in a group only
+active members of that group can be mentioned, so the feed never shows a
+message its reader could not open. Authors do not mention themselves.
+
+Mention rows live on ``default`` next to the users they point at, even for
+groups on another shard. ``manage.py backfill_mentions`` fills them in for
+history written before this existed.
+"""
+import re
+
+from django.conf import settings
+from django.db.models import Q
+
+from .fields import MARKER
+from .models import UserProfile, PublicChatHistory, GroupChatroomMember, GroupMessage, Mention
+from .sharding import fan_out, for_group, group_databases
+
+
+# Django usernames are letters, digits and @.+-_; a trailing '.' ends the sentence instead
+MENTION_RE = re.compile(r'(?<![\w@.+-])@([\w.@+-]*[\w@+-])')
+
+# Messages that may contain a mention; compressed values have to be parsed to know
+MIGHT_MENTION = Q(content__contains='@') | Q(content__startswith=MARKER)
+
+
+def extract_usernames(text):
+    """Usernames mentioned in ``text``, in order, without repeats"""
+    names = dict.fromkeys(MENTION_RE.findall(text))
+    return list(names)[:settings.CHAT_MENTIONS_MAX_PER_MESSAGE]
+
+
+def mentions_for_messages(messages):
+    """Unsaved Mention rows for a batch of messages of one model"""
+    names = {message.pk: extract_usernames(message.content) for message in messages}
+    wanted = {name for found in names.values() for name in found}
+    if not wanted:
+        return []
+    user_ids = dict(UserProfile.objects.filter(
+        username__in=wanted, is_active=True
+    ).values_list('username', 'pk'))
+
+    members = {}
+    for message in messages:
+        if isinstance(message, GroupMessage):
+            members.setdefault(message.group_id, set()).update(
+                user_ids[name] for name in names[message.pk] if name in user_ids
+            )
+    for group_id, candidates in members.items():
+        members[group_id] = set(for_group(GroupChatroomMember, group_id).filter(
+            user_id__in=candidates, is_active=True
+        ).values_list('user_id', flat=True))
+
+    mentions = []
+    for message in messages:
+        is_group = isinstance(message, GroupMessage)
+        for name in names[message.pk]:
+            user_id = user_ids.get(name)
+            if user_id is None or user_id == message.author_id:
+                continue
+            if is_group and user_id not in members[message.group_id]:
+                continue
+            if is_group:
+                mentions.append(Mention(user_id=user_id, group_message_id=message.pk,
+                                        group_id=message.group_id, created_at=message.timestamp))
+            else:
+                mentions.append(Mention(user_id=user_id, public_message_id=message.pk,
+                                        created_at=message.timestamp))
+    return mentions
+
+
+def _message_field(message):
+    return 'group_message' if isinstance(message, GroupMessage) else 'public_message'
+
+
+def sync_mentions(message, created=False):
+    """Make the Mention rows of ``message`` match its current content"""
+    if created and '@' not in message.content:
+        return
+    wanted = {mention.user_id: mention for mention in mentions_for_messages([message])}
+    existing = Mention.objects.filter(**{_message_field(message): message.pk})
+    current = set() if created else set(existing.values_list('user_id', flat=True))
+    if current - wanted.keys():
+        existing.filter(user_id__in=current - wanted.keys()).delete()
+    added = [mention for user_id, mention in wanted.items() if user_id not in current]
+    if added:
+        Mention.objects.bulk_create(added, ignore_conflicts=True)
+
+
+def forget_mentions(model, message_id):
+    """Delete the mentions of a deleted message, by id: the instance has lost its pk by commit time"""
+    field = 'group_message' if model is GroupMessage else 'public_message'
+    Mention.objects.filter(**{f'{field}_id': message_id}).delete()
+
+
+def visible_mentions(user):
+    """Mentions of ``user`` in public chat and in groups they are still an active member of"""
+    groups = [
+        group_id for queryset in fan_out(GroupChatroomMember.objects.filter(user=user, is_active=True))
+        for group_id in queryset.values_list('group_id', flat=True)
+    ]
+    return Mention.objects.filter(user=user).filter(Q(group__isnull=True) | Q(group_id__in=groups))
+
+
+def attach_messages(mentions, authors=True):
+    """Set ``mention.message`` on each mention, one query per model and shard"""
+    public_ids = [m.public_message_id for m in mentions if m.public_message_id]
+    public = PublicChatHistory.objects.filter(pk__in=public_ids)
+    messages = {
+        ('public', message.pk): message
+        for message in (public.select_related('author') if authors else public)
+    }
+    group_ids = {m.group_id for m in mentions if m.group_message_id}
+    for database, ids in group_databases(group_ids).items():
+        group = GroupMessage.objects.using(database).filter(
+            pk__in=[m.group_message_id for m in mentions if m.group_id in ids]
+        )
+        messages.update(
+            (('group', message.pk), message)
+            for message in (group.prefetch_related('author') if authors else group)
+        )
+    for mention in mentions:
+        key = ('group', mention.group_message_id) if mention.group_message_id else ('public', mention.public_message_id)
+        mention.message = messages.get(key)
+    return mentions
@@ -0,0 +1,375 @@
+"""
+Request metrics in the Prometheus text exposition format.
+
+MetricsMiddleware records, per view: requests by method and status, latency,
+time spent in database queries, and request and response body sizes. The
+long-poll waiter count and flood control totals are sampled when metrics are
+collected.
+
+Recording takes no lock: every thread writes to its own ViewMetrics, and readers
+sum the shards. With several worker processes, each process writes its
+totals to a file in CHAT_METRICS_DIR at most every
+CHAT_METRICS_FLUSH_INTERVAL seconds, and the metrics endpoint adds up every
+file. When a worker has exited, the next scrape folds its counters and
+histograms into ``retired.json`` and deletes its file, so totals never go
+backwards and the directory holds one file per live worker. Gauges of exited
+workers are dropped. Retiring needs fcntl, so on Windows every file is summed
+as if its worker were alive. Without CHAT_METRICS_DIR only the process answering the
+scrape is reported.
+
+``manage.py benchmark_metrics`` measures the cost per request.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: worker files are summed but never retired
+    fcntl = None
+
+
+METRICS = {
+    'chat_http_requests_total': ('counter', 'HTTP requests by view, method and status'),
+    'chat_http_request_duration_seconds': ('histogram', 'Time from the first middleware to the response'),
+    'chat_http_db_duration_seconds': ('histogram', 'Time spent in database queries per request'),
+    'chat_http_db_queries_total': ('counter', 'Database queries run by requests'),
+    'chat_http_request_size_bytes': ('histogram', 'Request body size from Content-Length'),
+    'chat_http_response_size_bytes': ('histogram', 'Response body size, streaming responses excluded'),
+    'chat_long_poll_waiting': ('gauge', 'Long-poll requests currently parked'),
+    'chat_flood_control_checks_total': ('counter', 'Message posts checked by flood control'),
+    'chat_flood_control_throttled_total': ('counter', 'Message posts refused by flood control'),
+}
+
+RETIRED = 'retired.json'
+
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_db_timer = ContextVar('chat_db_timer', default=None)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class ViewMetrics:
+    """What one thread recorded for one view; only that thread writes to it"""
+    __slots__ = ('requests', 'queries', 'latency', 'db_time', 'request_size', 'response_size')
+
+    def __init__(self):
+        latency_buckets = tuple(settings.CHAT_METRICS_LATENCY_BUCKETS)
+        # (method, status) -> count
+        self.requests = {}
+        self.queries = 0
+        self.latency = Histogram(latency_buckets)
+        self.db_time = Histogram(latency_buckets)
+        self.request_size = Histogram(SIZE_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+
+
+HISTOGRAMS = {
+    'chat_http_request_duration_seconds': 'latency',
+    'chat_http_db_duration_seconds': 'db_time',
+    'chat_http_request_size_bytes': 'request_size',
+    'chat_http_response_size_bytes': 'response_size',
+}
+
+
+class Registry:
+    def __init__(self):
+        self._local = threading.local()
+        # One {view name: ViewMetrics} dict per thread
+        self._shards = []
+        self.next_flush = 0
+
+    def view(self, name):
+        try:
+            views = self._local.views
+        except AttributeError:
+            views = self._local.views = {}
+            # list.append is atomic, so registering needs no lock either
+            self._shards.append(views)
+        metrics = views.get(name)
+        if metrics is None:
+            metrics = views[name] = ViewMetrics()
+        return metrics
+
+    def snapshot(self):
+        """This process's totals as a JSON-friendly dict"""
+        counters = {}
+        histograms = {}
+        for views in list(self._shards):
+            # dict.copy() runs without releasing the GIL, so it sees a consistent dict
+            for name, metrics in views.copy().items():
+                view = (('view', name),)
+                for (method, status_code), count in metrics.requests.copy().items():
+                    key = ('chat_http_requests_total', view + (('method', method), ('status', status_code)))
+                    counters[key] = counters.get(key, 0) + count
+                if metrics.queries:
+                    key = ('chat_http_db_queries_total', view)
+                    counters[key] = counters.get(key, 0) + metrics.queries
+                for metric, attribute in HISTOGRAMS.items():
+                    histogram = getattr(metrics, attribute)
+                    if not histogram.sum and not any(histogram.counts):
+                        continue
+                    merged = histograms.setdefault((metric, view), [[0] * len(histogram.counts), 0, histogram.buckets])
+                    merged[0] = [a + b for a, b in zip(merged[0], histogram.counts)]
+                    merged[1] += histogram.sum
+        return {
+            'pid': os.getpid(),
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()]
+                        + [[name, (), value] for name, value in _sampled_counters()],
+            'histograms': [[name, labels, *histogram] for (name, labels), histogram in histograms.items()],
+            'gauges': [[name, (), value] for name, value in _sampled_gauges()],
+        }
+
+    def flush(self, force=False):
+        """Write this process's snapshot to CHAT_METRICS_DIR if one is configured"""
+        now = time.monotonic()
+        if not force and now < self.next_flush:
+            return
+        self.next_flush = now + settings.CHAT_METRICS_FLUSH_INTERVAL
+        directory = settings.CHAT_METRICS_DIR
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        """Snapshots of every worker process, this one read live, plus the retired totals"""
+        snapshots = [self.snapshot()]
+        directory = settings.CHAT_METRICS_DIR
+        if directory and os.path.isdir(directory):
+            exited = []
+            for filename in os.listdir(directory):
+                if not filename.endswith('.json') or filename in (f'{os.getpid()}.json', RETIRED):
+                    continue
+                snapshot = _load(os.path.join(directory, filename))
+                if snapshot is None:
+                    continue
+                if fcntl is None or _alive(snapshot['pid']):
+                    snapshots.append(snapshot)
+                else:
+                    exited.append(filename)
+            retired = _retire(directory, exited) if exited else _load(os.path.join(directory, RETIRED))
+            if retired is not None:
+                snapshots.append(retired)
+        return snapshots
+
+
+registry = Registry()
+atexit.register(registry.flush, force=True)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _retire(directory, filenames):
+    """Add the snapshots of exited processes to retired.json, delete them, and return the new totals"""
+    path = os.path.join(directory, RETIRED)
+    with open(os.path.join(directory, 'retired.lock'), 'w') as lock:
+        # Scrapes in other workers may be retiring the same files
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        snapshots = [snapshot for snapshot in [_load(path)] if snapshot is not None]
+        retiring = []
+        for filename in filenames:
+            snapshot = _load(os.path.join(directory, filename))
+            if snapshot is not None:
+                snapshot['gauges'] = []
+                snapshots.append(snapshot)
+                retiring.append(filename)
+        scalars, histograms = _merge(snapshots)
+        retired = {
+            'pid': None,
+            'counters': [[name, labels, value] for (name, labels), value in scalars.items()],
+            'histograms': [[name, labels, *histogram] for (name, labels), histogram in histograms.items()],
+            'gauges': [],
+        }
+        with open(path + '.tmp', 'w') as f:
+            json.dump(retired, f)
+        os.replace(path + '.tmp', path)
+        for filename in retiring:
+            os.remove(os.path.join(directory, filename))
+    return retired
+
+
+def _sampled_gauges():
+    from .notifications import notifier
+    yield 'chat_long_poll_waiting', notifier.waiting
+
+
+def _sampled_counters():
+    from .throttling import flood_control
+    yield 'chat_flood_control_checks_total', flood_control.checked
+    yield 'chat_flood_control_throttled_total', flood_control.throttled
+
+
+def _format_labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _merge(snapshots):
+    """Add snapshots up: ({(name, labels): value}, {(name, labels): [counts, sum, buckets]})"""
+    scalars = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters'] + snapshot['gauges']:
+            key = (name, tuple(map(tuple, labels)))
+            scalars[key] = scalars.get(key, 0) + value
+        for name, labels, counts, total, buckets in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [[0] * len(counts), 0, tuple(buckets)])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+    return scalars, histograms
+
+
+def exposition(snapshots):
+    """Render merged snapshots in the text exposition format (version 0.0.4)"""
+    scalars, histograms = _merge(snapshots)
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'histogram':
+            for (metric, labels), (counts, total, buckets) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*buckets, float('inf')), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", _format_number(bound))])} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_number(total)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        else:
+            for (metric, labels), value in sorted(scalars.items()):
+                if metric == name:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_number(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+class DatabaseTimer:
+    __slots__ = ('seconds', 'queries')
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.queries = 0
+
+
+def _time_query(execute, sql, params, many, context):
+    timer = _db_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.seconds += time.perf_counter() - start
+        timer.queries += 1
+
+
+def install_query_timer(connection):
+    # Installed once per connection and left in place; it only times queries
+    # run while a request has set _db_timer, including from sync_to_async threads
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _time_query)
+
+
+class MetricsMiddleware:
+    """Record per-view request metrics; put it first in MIDDLEWARE"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timer = DatabaseTimer()
+        token = _db_timer.set(timer)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _db_timer.reset(token)
+        self.record(request, response, time.perf_counter() - start, timer)
+        return response
+
+    async def __acall__(self, request):
+        timer = DatabaseTimer()
+        token = _db_timer.set(timer)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _db_timer.reset(token)
+        self.record(request, response, time.perf_counter() - start, timer)
+        return response
+
+    def record(self, request, response, elapsed, timer):
+        match = request.resolver_match
+        metrics = registry.view(match.view_name if match else 'unmatched')
+        key = (request.method, response.status_code)
+        metrics.requests[key] = metrics.requests.get(key, 0) + 1
+        metrics.latency.observe(elapsed)
+        metrics.db_time.observe(timer.seconds)
+        metrics.queries += timer.queries
+        length = request.META.get('CONTENT_LENGTH')
+        if length and length.isdigit():
+            metrics.request_size.observe(int(length))
+        if not response.streaming:
+            metrics.response_size.observe(len(response.content))
+        if time.monotonic() >= registry.next_flush:
+            registry.flush()
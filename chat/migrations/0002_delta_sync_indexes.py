@@ -0,0 +1,50 @@
+# Generated by Django 6.0.2 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='privatemessage',
+            name='chat_privat_sender__c5decf_idx',
+        ),
+        migrations.AddField(
+            model_name='groupchatroommember',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='groupchatroommember',
+            index=models.Index(fields=['group', 'updated_at'], name='chat_groupc_group_i_5fff00_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupchatroommember',
+            index=models.Index(fields=['user', 'updated_at'], name='chat_groupc_user_id_34d359_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'id'], name='chat_groupm_group_i_36ba3c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'edited_at'], name='chat_groupm_group_i_d48c0f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['sender', 'receiver', 'id'], name='chat_privat_sender__c7f354_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['sender', 'receiver', 'edited_at'], name='chat_privat_sender__733f3d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publicchathistory',
+            index=models.Index(fields=['edited_at'], name='chat_public_edited__19b573_idx'),
+        ),
+    ]
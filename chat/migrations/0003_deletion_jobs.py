@@ -0,0 +1,49 @@
+# Generated by Django 6.0.2 on 2026-10-19 10:05
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_delta_sync_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetentionPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room', models.CharField(help_text="'public' or 'group:<id>'", max_length=50, unique=True, validators=[django.core.validators.RegexValidator('^(public|group:\\d+)$')])),
+                ('max_age_days', models.PositiveIntegerField()),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'retention policies',
+                'ordering': ['room'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DeletionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('user', 'User removal'), ('retention', 'Retention purge')], max_length=20)),
+                ('user_id', models.BigIntegerField(blank=True, null=True)),
+                ('room', models.CharField(blank=True, max_length=50)),
+                ('cutoff', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('stage', models.CharField(blank=True, max_length=50)),
+                ('rows_deleted', models.BigIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='chat_deleti_status_5dc922_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0.2 on 2026-10-19 11:20
+
+import chat.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_deletion_jobs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='content',
+            field=chat.fields.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='privatemessage',
+            name='content',
+            field=chat.fields.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='publicchathistory',
+            name='content',
+            field=chat.fields.CompressedTextField(),
+        ),
+    ]
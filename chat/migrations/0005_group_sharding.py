@@ -0,0 +1,91 @@
+# Generated by Django 6.0.2 on 2026-10-19 12:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_compressed_content'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupShard',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard', serialize=False, to='chat.groupchatroom')),
+                ('database', models.CharField(max_length=50)),
+                ('is_moving', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ShardSequence',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='chatfile',
+            name='group_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='files', to='chat.groupmessage'),
+        ),
+        migrations.AlterField(
+            model_name='chatfile',
+            name='private_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='files', to='chat.privatemessage'),
+        ),
+        migrations.AlterField(
+            model_name='chatfile',
+            name='public_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='files', to='chat.publicchathistory'),
+        ),
+        migrations.AlterField(
+            model_name='chatfile',
+            name='uploaded_by',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='chatimage',
+            name='group_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='images', to='chat.groupmessage'),
+        ),
+        migrations.AlterField(
+            model_name='chatimage',
+            name='private_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='images', to='chat.privatemessage'),
+        ),
+        migrations.AlterField(
+            model_name='chatimage',
+            name='public_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='images', to='chat.publicchathistory'),
+        ),
+        migrations.AlterField(
+            model_name='chatimage',
+            name='uploaded_by',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='groupchatroommember',
+            name='group',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='members', to='chat.groupchatroom'),
+        ),
+        migrations.AlterField(
+            model_name='groupchatroommember',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='group_memberships', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='author',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='group_messages', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='group',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.groupchatroom'),
+        ),
+    ]
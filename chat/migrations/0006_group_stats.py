@@ -0,0 +1,42 @@
+# Generated by Django 6.0.2 on 2026-10-19 13:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_group_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupStats',
+            fields=[
+                ('group', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='chat.groupchatroom')),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name_plural': 'group stats',
+                'indexes': [models.Index(fields=['last_message_at'], name='chat_groups_last_me_2d9dea_idx'), models.Index(fields=['message_count'], name='chat_groups_message_1ab75c_idx'), models.Index(fields=['member_count'], name='chat_groups_member__9c6bad_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='GroupActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='activity', to='chat.groupchatroom')),
+            ],
+            options={
+                'verbose_name_plural': 'group activity',
+                'indexes': [models.Index(fields=['hour'], name='chat_groupa_hour_c2f850_idx')],
+                'unique_together': {('group', 'hour')},
+            },
+        ),
+    ]
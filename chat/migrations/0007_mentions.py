@@ -0,0 +1,33 @@
+# Generated by Django 6.0.2 on 2026-10-19 14:05
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_group_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Mention',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('is_read', models.BooleanField(default=False)),
+                ('group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to='chat.groupchatroom')),
+                ('group_message', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to='chat.groupmessage')),
+                ('public_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to='chat.publicchathistory')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='mentions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['user', 'id'], name='chat_mentio_user_id_f3bc7c_idx'), models.Index(fields=['user', 'is_read'], name='chat_mentio_user_id_8e0eac_idx')],
+                'unique_together': {('user', 'group_message'), ('user', 'public_message')},
+            },
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 6.0.2 on 2026-10-19 14:30
+
+import chat.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_mentions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmessage',
+            name='content_html',
+            field=chat.fields.CompressedTextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='render_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='groupmessage',
+            name='rendered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='content_html',
+            field=chat.fields.CompressedTextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='render_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='privatemessage',
+            name='rendered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='publicchathistory',
+            name='content_html',
+            field=chat.fields.CompressedTextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='publicchathistory',
+            name='render_version',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='publicchathistory',
+            name='rendered_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['render_version'], name='chat_groupm_render__b2631e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='privatemessage',
+            index=models.Index(fields=['render_version'], name='chat_privat_render__824390_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='publicchathistory',
+            index=models.Index(fields=['render_version'], name='chat_public_render__de9f1b_idx'),
+        ),
+    ]
@@ -1,7 +1,78 @@
-from django.db import models
+from django.core.validators import RegexValidator
+from django.db import models, router
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 
+from .fields import CompressedTextField, PackedText
+
+
+class GroupShardQuerySet(models.QuerySet):
+    """
+    Sends create(), get_or_create() and update_or_create() through the router
+    with the row as hint, so they read and write on its group's shard
+    """
+
+    def create(self, **kwargs):
+        if self._db is not None:
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True, using=router.db_for_write(self.model, instance=obj))
+        return obj
+
+    def _for_row(self, fields):
+        """This queryset on the database a row with ``fields`` would be written to"""
+        if self._db is not None:
+            return self
+        hint = self.model(**{
+            name: value for name, value in fields.items() if '__' not in name and not callable(value)
+        })
+        return self.using(router.db_for_write(self.model, instance=hint))
+
+    def get_or_create(self, defaults=None, **kwargs):
+        queryset = self._for_row({**(defaults or {}), **kwargs})
+        return super(GroupShardQuerySet, queryset).get_or_create(defaults, **kwargs)
+
+    def update_or_create(self, defaults=None, create_defaults=None, **kwargs):
+        queryset = self._for_row({**(create_defaults or defaults or {}), **kwargs})
+        return super(GroupShardQuerySet, queryset).update_or_create(defaults, create_defaults, **kwargs)
+
+
+class RenderedContentMixin:
+    """
+    Remembers the content a message was loaded or last saved with, so saves
+    can tell whether the text changed (chat/rendering.py renders it again,
+    chat/mentions.py re-parses it), and saves the rendered HTML along with
+    content when update_fields is used
+    """
+    RENDER_FIELDS = ('content_html', 'render_version', 'rendered_at')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stored form, still packed if compressed; absent if deferred
+        instance._loaded_content = instance.__dict__.get('content')
+        return instance
+
+    def content_changed(self):
+        """Whether ``content`` was changed since the message was loaded or last saved"""
+        current = self.__dict__.get('content')
+        loaded = getattr(self, '_loaded_content', None)
+        if current is loaded or current is None:
+            # Untouched, still packed, or deferred and so not being saved
+            return False
+        if isinstance(loaded, PackedText):
+            loaded = loaded.unpack()
+        return current != loaded
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is not None and 'content' in update_fields:
+            update_fields = {*update_fields, *self.RENDER_FIELDS}
+        super().save(*args, update_fields=update_fields, **kwargs)
+        # After the post_save handlers, which still compare against the old content
+        if update_fields is None or 'content' in update_fields:
+            self._loaded_content = self.__dict__.get('content')
+
 
 class UserProfile(AbstractUser):
     """Custom user model with additional chat-related fields"""
@@ -22,13 +93,17 @@ class UserProfile(AbstractUser):
         return f"{self.display_name or self.username}'s profile"
 
 
-class PublicChatHistory(models.Model):
+class PublicChatHistory(RenderedContentMixin, models.Model):
     """Public chat messages visible to all users"""
     author = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='public_messages')
-    content = models.TextField()
+    content = CompressedTextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
+    # Markdown rendered by chat/rendering.py
+    content_html = CompressedTextField(blank=True, default='')
+    render_version = models.PositiveSmallIntegerField(default=0)
+    rendered_at = models.DateTimeField(null=True, blank=True)
     message_type = models.CharField(max_length=20, choices=[
         ('text', 'Text'),
         ('image', 'Image'),
@@ -39,19 +114,27 @@ class PublicChatHistory(models.Model):
     
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['edited_at']),
+            models.Index(fields=['render_version']),
+        ]
     
     def __str__(self):
         return f"{self.author.display_name or self.author.username}: {self.content[:50]}..."
 
 
-class PrivateMessage(models.Model):
+class PrivateMessage(RenderedContentMixin, models.Model):
     """Private messages between two users"""
     sender = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='received_messages')
-    content = models.TextField()
+    content = CompressedTextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
+    # Markdown rendered by chat/rendering.py
+    content_html = CompressedTextField(blank=True, default='')
+    render_version = models.PositiveSmallIntegerField(default=0)
+    rendered_at = models.DateTimeField(null=True, blank=True)
     message_type = models.CharField(max_length=20, choices=[
         ('text', 'Text'),
         ('image', 'Image'),
@@ -64,8 +147,10 @@ class PrivateMessage(models.Model):
     class Meta:
         ordering = ['-timestamp']
         indexes = [
-            models.Index(fields=['sender', 'receiver']),
+            models.Index(fields=['sender', 'receiver', 'id']),
+            models.Index(fields=['sender', 'receiver', 'edited_at']),
             models.Index(fields=['receiver', 'is_read']),
+            models.Index(fields=['render_version']),
         ]
     
     def __str__(self):
@@ -92,8 +177,8 @@ class GroupChatroom(models.Model):
 
 class GroupChatroomMember(models.Model):
     """Many-to-many relationship for group chat participants"""
-    group = models.ForeignKey(GroupChatroom, on_delete=models.CASCADE, related_name='members')
-    user = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='group_memberships')
+    group = models.ForeignKey(GroupChatroom, on_delete=models.CASCADE, related_name='members', db_constraint=False)
+    user = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='group_memberships', db_constraint=False)
     joined_at = models.DateTimeField(auto_now_add=True)
     role = models.CharField(max_length=20, choices=[
         ('admin', 'Admin'),
@@ -102,26 +187,35 @@ class GroupChatroomMember(models.Model):
     ], default='member')
     is_active = models.BooleanField(default=True)
     last_read_message_id = models.IntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = GroupShardQuerySet.as_manager()
     
     class Meta:
         unique_together = ['group', 'user']
         indexes = [
             models.Index(fields=['group', 'is_active']),
             models.Index(fields=['user', 'is_active']),
+            models.Index(fields=['group', 'updated_at']),
+            models.Index(fields=['user', 'updated_at']),
         ]
     
     def __str__(self):
         return f"{self.user.display_name or self.user.username} in {self.group.name}"
 
 
-class GroupMessage(models.Model):
+class GroupMessage(RenderedContentMixin, models.Model):
     """Messages within group chat rooms"""
-    group = models.ForeignKey(GroupChatroom, on_delete=models.CASCADE, related_name='messages')
-    author = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='group_messages')
-    content = models.TextField()
+    group = models.ForeignKey(GroupChatroom, on_delete=models.CASCADE, related_name='messages', db_constraint=False)
+    author = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='group_messages', db_constraint=False)
+    content = CompressedTextField()
     timestamp = models.DateTimeField(auto_now_add=True)
     edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
+    # Markdown rendered by chat/rendering.py
+    content_html = CompressedTextField(blank=True, default='')
+    render_version = models.PositiveSmallIntegerField(default=0)
+    rendered_at = models.DateTimeField(null=True, blank=True)
     message_type = models.CharField(max_length=20, choices=[
         ('text', 'Text'),
         ('image', 'Image'),
@@ -130,10 +224,15 @@ class GroupMessage(models.Model):
     ], default='text')
     reply_to = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replies')
     
+    objects = GroupShardQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-timestamp']
         indexes = [
             models.Index(fields=['group', 'timestamp']),
+            models.Index(fields=['group', 'id']),
+            models.Index(fields=['group', 'edited_at']),
+            models.Index(fields=['render_version']),
         ]
     
     def __str__(self):
@@ -146,13 +245,16 @@ class ChatFile(models.Model):
     original_name = models.CharField(max_length=255)
     file_size = models.BigIntegerField()
     file_type = models.CharField(max_length=100)
-    uploaded_by = models.ForeignKey('UserProfile', on_delete=models.CASCADE)
+    uploaded_by = models.ForeignKey('UserProfile', on_delete=models.CASCADE, db_constraint=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     
     # Optional: Link to specific message where file was shared
-    public_message = models.ForeignKey(PublicChatHistory, on_delete=models.SET_NULL, null=True, blank=True, related_name='files')
-    private_message = models.ForeignKey(PrivateMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='files')
-    group_message = models.ForeignKey(GroupMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='files')
+    # (no database constraints: rows may live on a group's shard, see chat/sharding.py)
+    public_message = models.ForeignKey(PublicChatHistory, on_delete=models.SET_NULL, null=True, blank=True, related_name='files', db_constraint=False)
+    private_message = models.ForeignKey(PrivateMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='files', db_constraint=False)
+    group_message = models.ForeignKey(GroupMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='files', db_constraint=False)
+    
+    objects = GroupShardQuerySet.as_manager()
     
     class Meta:
         ordering = ['-uploaded_at']
@@ -171,13 +273,16 @@ class ChatImage(models.Model):
     file_size = models.BigIntegerField()
     width = models.IntegerField(null=True, blank=True)
     height = models.IntegerField(null=True, blank=True)
-    uploaded_by = models.ForeignKey('UserProfile', on_delete=models.CASCADE)
+    uploaded_by = models.ForeignKey('UserProfile', on_delete=models.CASCADE, db_constraint=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     
     # Optional: Link to specific message where image was shared
-    public_message = models.ForeignKey(PublicChatHistory, on_delete=models.SET_NULL, null=True, blank=True, related_name='images')
-    private_message = models.ForeignKey(PrivateMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='images')
-    group_message = models.ForeignKey(GroupMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='images')
+    # (no database constraints: rows may live on a group's shard, see chat/sharding.py)
+    public_message = models.ForeignKey(PublicChatHistory, on_delete=models.SET_NULL, null=True, blank=True, related_name='images', db_constraint=False)
+    private_message = models.ForeignKey(PrivateMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='images', db_constraint=False)
+    group_message = models.ForeignKey(GroupMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='images', db_constraint=False)
+    
+    objects = GroupShardQuerySet.as_manager()
     
     class Meta:
         ordering = ['-uploaded_at']
@@ -187,3 +292,135 @@ class ChatImage(models.Model):
     
     def __str__(self):
         return f"{self.original_name} uploaded by {self.uploaded_by.display_name or self.uploaded_by.username}"
+
+
+class RetentionPolicy(models.Model):
+    """Delete messages in a room once they are older than max_age_days"""
+    room = models.CharField(max_length=50, unique=True, help_text="'public' or 'group:<id>'",
+                            validators=[RegexValidator(r'^(public|group:\d+)$')])
+    max_age_days = models.PositiveIntegerField()
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['room']
+        verbose_name_plural = 'retention policies'
+    
+    def __str__(self):
+        return f"{self.room}: {self.max_age_days} days"
+
+
+class DeletionJob(models.Model):
+    """A user removal or retention purge, processed in batches by process_deletions"""
+    kind = models.CharField(max_length=20, choices=[
+        ('user', 'User removal'),
+        ('retention', 'Retention purge')
+    ])
+    # Plain ids rather than foreign keys: the job must outlive the user it removes
+    user_id = models.BigIntegerField(null=True, blank=True)
+    room = models.CharField(max_length=50, blank=True)
+    cutoff = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=20, choices=[
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed')
+    ], default='pending')
+    stage = models.CharField(max_length=50, blank=True)
+    rows_deleted = models.BigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+    
+    def __str__(self):
+        target = f"user {self.user_id}" if self.kind == 'user' else self.room
+        return f"{self.get_kind_display()} of {target} ({self.status})"
+
+
+class GroupShard(models.Model):
+    """Which database holds a group's messages and members (see chat/sharding.py)"""
+    group = models.OneToOneField(GroupChatroom, on_delete=models.CASCADE, primary_key=True, related_name='shard')
+    database = models.CharField(max_length=50)
+    # Writes to the group are refused while move_group copies its final changes
+    is_moving = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.group_id} on {self.database}"
+
+
+class ShardSequence(models.Model):
+    """Shared primary key sequence for a sharded model"""
+    name = models.CharField(max_length=100, primary_key=True)
+    next_value = models.BigIntegerField()
+    
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
+
+class GroupStats(models.Model):
+    """Running totals for a group, maintained by chat/stats.py"""
+    group = models.OneToOneField(GroupChatroom, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    message_count = models.PositiveIntegerField(default=0)
+    member_count = models.PositiveIntegerField(default=0)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        verbose_name_plural = 'group stats'
+        indexes = [
+            models.Index(fields=['last_message_at']),
+            models.Index(fields=['message_count']),
+            models.Index(fields=['member_count']),
+        ]
+    
+    def __str__(self):
+        return f"{self.group_id}: {self.message_count} messages, {self.member_count} members"
+
+
+class GroupActivity(models.Model):
+    """Messages posted in a group during one UTC hour"""
+    group = models.ForeignKey(GroupChatroom, on_delete=models.CASCADE, related_name='activity')
+    hour = models.DateTimeField()
+    message_count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ['group', 'hour']
+        verbose_name_plural = 'group activity'
+        indexes = [
+            models.Index(fields=['hour']),
+        ]
+    
+    def __str__(self):
+        return f"{self.group_id} at {self.hour:%Y-%m-%d %H:00}: {self.message_count}"
+
+
+class Mention(models.Model):
+    """A user @mentioned in a public or group message (see chat/mentions.py)"""
+    user = models.ForeignKey('UserProfile', on_delete=models.CASCADE, related_name='mentions')
+    public_message = models.ForeignKey(PublicChatHistory, on_delete=models.CASCADE, null=True, blank=True, related_name='mentions')
+    # No database constraint: the message may live on a group's shard
+    group_message = models.ForeignKey(GroupMessage, on_delete=models.CASCADE, null=True, blank=True, related_name='mentions', db_constraint=False)
+    group = models.ForeignKey(GroupChatroom, on_delete=models.CASCADE, null=True, blank=True, related_name='mentions')
+    # The message's timestamp, so backfilled mentions sort with live ones
+    created_at = models.DateTimeField(default=timezone.now)
+    is_read = models.BooleanField(default=False)
+    
+    class Meta:
+        ordering = ['-id']
+        unique_together = [['user', 'public_message'], ['user', 'group_message']]
+        indexes = [
+            models.Index(fields=['user', 'id']),
+            models.Index(fields=['user', 'is_read']),
+        ]
+    
+    def __str__(self):
+        room = f"group:{self.group_id}" if self.group_id else 'public'
+        return f"{self.user_id} mentioned in {room}"
@@ -0,0 +1,94 @@
+"""
+In-process wakeups for parked long-poll requests.
+
+Writers call ``notifier.publish(channel)`` (see signals.py); each parked
+request holds a Subscription, which is just an asyncio.Event on the event
+loop that is serving it. No polling is involved, so an idle subscription
+costs a few hundred bytes and no CPU.
+
+Notifications do not cross process boundaries. With several workers a
+request parked in one process is only woken by writes made in that same
+process; otherwise it falls back to its timeout, after which the client
+polls again and picks up the message from the database.
+"""
+import asyncio
+import threading
+
+
+class Subscription:
+    """The set of channels one parked request is waiting on"""
+
+    def __init__(self, notifier, channels):
+        self.notifier = notifier
+        self.channels = frozenset(channels)
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+        self.fired = set()
+
+    def _wake(self, channel):
+        # Always runs on self.loop
+        self.fired.add(channel)
+        self.event.set()
+
+    async def wait(self, timeout):
+        """Wait until a channel fires or ``timeout`` seconds pass; return fired channels"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return set(self.fired)
+
+    def close(self):
+        self.notifier.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MessageNotifier:
+    """Registry of parked subscriptions keyed by channel"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, channels):
+        """Must be called from inside a running event loop"""
+        subscription = Subscription(self, channels)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscribers.get(channel)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    def publish(self, channel):
+        """Wake every subscription on ``channel``; safe to call from any thread"""
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._wake, channel)
+            except RuntimeError:
+                # The loop serving this request has already shut down
+                pass
+
+    @property
+    def waiting(self):
+        """Number of parked subscriptions"""
+        with self._lock:
+            return len({s for subs in self._subscribers.values() for s in subs})
+
+
+notifier = MessageNotifier()
@@ -0,0 +1,94 @@
+"""
+Shared cache of the public part of user profiles, versioned by updated_at.
+
+A profile's version is its ``updated_at`` in microseconds. The cache (the
+CHAT_PROFILE_CACHE alias of CACHES) holds two kinds of entries:
+
+* ``chat:profile-version:<id>``: the current version of a user, rewritten
+  whenever the user is saved;
+* ``chat:profile:<id>:<version>``: the serialized profile at that version,
+  which never needs invalidating because a change makes a new key.
+
+Message payloads requested with ``?authors=ids`` carry ``{"id", "version"}``
+per author instead of the nested profile, so the server skips the user
+join and clients only call ``users/resolve/`` for versions they have not
+seen. Share the cache between workers (e.g. Redis) for the versions to stay
+exact across processes; with the default local-memory cache each process
+also rewrites its own copy, and a change made by another worker shows up
+after CHAT_PROFILE_CACHE_TIMEOUT at the latest.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import UserProfile
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def _cache():
+    return caches[settings.CHAT_PROFILE_CACHE]
+
+
+def _version_key(user_id):
+    return f'chat:profile-version:{user_id}'
+
+
+def _profile_key(user_id, version):
+    return f'chat:profile:{user_id}:{version}'
+
+
+def profile_version(user):
+    return (user.updated_at - EPOCH) // timedelta(microseconds=1)
+
+
+def profile_versions(user_ids):
+    """Map user id -> current profile version; ids of deleted users are left out"""
+    cache = _cache()
+    keys = {_version_key(user_id): user_id for user_id in set(user_ids)}
+    versions = {keys[key]: version for key, version in cache.get_many(keys).items()}
+    missing = keys.values() - versions.keys()
+    if missing:
+        loaded = {
+            user_id: (updated_at - EPOCH) // timedelta(microseconds=1)
+            for user_id, updated_at in UserProfile.objects.filter(pk__in=missing).values_list('pk', 'updated_at')
+        }
+        cache.set_many({_version_key(user_id): version for user_id, version in loaded.items()},
+                       timeout=settings.CHAT_PROFILE_CACHE_TIMEOUT)
+        versions.update(loaded)
+    return versions
+
+
+def resolve_profiles(user_ids):
+    """Map user id -> serialized profile (with its version) for the users that exist"""
+    from .serializers import UserDirectorySerializer
+
+    cache = _cache()
+    versions = profile_versions(user_ids)
+    keys = {_profile_key(user_id, version): user_id for user_id, version in versions.items()}
+    profiles = {keys[key]: profile for key, profile in cache.get_many(keys).items()}
+    missing = versions.keys() - profiles.keys()
+    if missing:
+        loaded = {
+            user.pk: UserDirectorySerializer(user).data
+            for user in UserProfile.objects.filter(pk__in=missing)
+        }
+        # Keyed by the version actually loaded, which may be newer than the cached pointer
+        cache.set_many({_profile_key(user_id, profile['version']): profile for user_id, profile in loaded.items()},
+                       timeout=settings.CHAT_PROFILE_CACHE_TIMEOUT)
+        profiles.update(loaded)
+    return profiles
+
+
+def profile_changed(user):
+    _cache().set(_version_key(user.pk), profile_version(user), timeout=settings.CHAT_PROFILE_CACHE_TIMEOUT)
+
+
+def profile_deleted(user_id):
+    _cache().delete(_version_key(user_id))
+
+
+def author_ids(messages):
+    return {getattr(message, 'sender_id', None) or message.author_id for message in messages}
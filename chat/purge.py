@@ -0,0 +1,181 @@
+"""
+Batched deletion of users and expired messages.
+
+Deleting a UserProfile in one go cascades through every message they wrote
+and every group they created inside a single transaction. Instead, a
+DeletionJob removes the dependent rows a batch at a time, each batch in its
+own short transaction with a pause in between, and deletes the user row
+last. Every stage deletes "whatever still matches", so a job interrupted at
+any point is resumed simply by running it again.
+
+A worker claims a job with a conditional UPDATE before running it, so two
+process_deletions daemons (or one and ``purge_user --now``) never run the
+same job at once. Every batch refreshes the job's updated_at. A job left
+``running`` by a worker that died is claimable again once updated_at is
+CHAT_DELETION_STALE_AFTER seconds old.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from .conversations import Conversation
+from .models import (
+    UserProfile, PublicChatHistory, PrivateMessage,
+    GroupChatroom, GroupChatroomMember, GroupMessage,
+    ChatFile, ChatImage, RetentionPolicy, DeletionJob
+)
+from .sharding import fan_out, for_group, group_databases
+
+
+class JobTaken(Exception):
+    """Raised by run_job for a job another worker is running"""
+
+
+def _sharded(name, queryset):
+    """One stage per database that can hold group data"""
+    return [
+        (name if part.db == 'default' else f'{name}@{part.db}', part)
+        for part in fan_out(queryset)
+    ]
+
+
+def _created_group_stages(name, model, group_ids):
+    return [
+        (name if database == 'default' else f'{name}@{database}',
+         model.objects.using(database).filter(group_id__in=ids))
+        for database, ids in group_databases(group_ids).items()
+    ]
+
+
+def _user_stages(user_id):
+    """(stage name, queryset) pairs, in the order they are emptied"""
+    created_groups = list(GroupChatroom.objects.filter(created_by_id=user_id).values_list('pk', flat=True))
+    return (
+        _sharded('files', ChatFile.objects.filter(uploaded_by_id=user_id)) +
+        _sharded('images', ChatImage.objects.filter(uploaded_by_id=user_id)) + [
+            ('public_messages', PublicChatHistory.objects.filter(author_id=user_id)),
+            ('sent_messages', PrivateMessage.objects.filter(sender_id=user_id)),
+            ('received_messages', PrivateMessage.objects.filter(receiver_id=user_id)),
+        ] +
+        _sharded('group_messages', GroupMessage.objects.filter(author_id=user_id)) +
+        _sharded('group_memberships', GroupChatroomMember.objects.filter(user_id=user_id)) +
+        _created_group_stages('created_group_messages', GroupMessage, created_groups) +
+        _created_group_stages('created_group_members', GroupChatroomMember, created_groups) + [
+            ('created_groups', GroupChatroom.objects.filter(created_by_id=user_id)),
+            ('user', UserProfile.objects.filter(pk=user_id)),
+        ]
+    )
+
+
+def _retention_stages(room, cutoff):
+    conversation = Conversation.parse(room)
+    if conversation.kind == 'public':
+        messages = PublicChatHistory.objects.all()
+    else:
+        messages = for_group(GroupMessage, conversation.target_id)
+    return [('messages', messages.filter(timestamp__lt=cutoff))]
+
+
+def _stored_files(queryset, pks):
+    if queryset.model is ChatFile:
+        return [f.file for f in queryset.filter(pk__in=pks)]
+    if queryset.model is ChatImage:
+        return [i.image for i in queryset.filter(pk__in=pks)]
+    return []
+
+
+def delete_batch(queryset, batch_size):
+    """Delete one batch of ``queryset``; return the number of rows removed"""
+    pks = list(queryset.order_by().values_list('pk', flat=True)[:batch_size])
+    if not pks:
+        return 0
+    database = queryset.db
+    stored = _stored_files(queryset, pks)
+    with transaction.atomic(using=database):
+        deleted, _ = queryset.model._base_manager.using(database).filter(pk__in=pks).delete()
+        for field_file in stored:
+            transaction.on_commit(
+                lambda f=field_file: f.storage.delete(f.name) if f.name else None,
+                using=database
+            )
+    return deleted
+
+
+def claim_job(job):
+    """Mark ``job`` running for this worker and reload it; False if another worker holds it"""
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.CHAT_DELETION_STALE_AFTER)
+    claimed = DeletionJob.objects.filter(pk=job.pk).filter(
+        Q(status='pending') | Q(status='running', updated_at__lt=stale)
+    ).update(status='running', updated_at=now)
+    if claimed:
+        job.refresh_from_db()
+    return bool(claimed)
+
+
+def run_job(job, batch_size=None, pause=None, log=None):
+    """Claim ``job`` and process it to completion, resuming from its last recorded stage"""
+    if not claim_job(job):
+        raise JobTaken(f'{job} is already being processed')
+    batch_size = batch_size or settings.CHAT_DELETION_BATCH_SIZE
+    pause = settings.CHAT_DELETION_PAUSE if pause is None else pause
+    if job.kind == 'user':
+        stages = _user_stages(job.user_id)
+    else:
+        stages = _retention_stages(job.room, job.cutoff)
+
+    names = [name for name, _ in stages]
+    start = names.index(job.stage) if job.stage in names else 0
+    try:
+        for name, queryset in stages[start:]:
+            job.stage = name
+            while deleted := delete_batch(queryset, batch_size):
+                job.rows_deleted += deleted
+                job.save(update_fields=['stage', 'rows_deleted', 'updated_at'])
+                if log:
+                    log(f'{job}: {name}, {job.rows_deleted} rows deleted')
+                time.sleep(pause)
+    except Exception as e:
+        job.status = 'failed'
+        job.error = str(e)
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        raise
+    job.status = 'done'
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'stage', 'finished_at', 'updated_at'])
+    return job
+
+
+def schedule_user_deletion(user):
+    """Lock ``user`` out now and queue the removal of their data"""
+    with transaction.atomic():
+        UserProfile.objects.filter(pk=user.pk).update(is_active=False, status='offline')
+        Token.objects.filter(user_id=user.pk).delete()
+        job, _ = DeletionJob.objects.get_or_create(
+            kind='user', user_id=user.pk, status__in=['pending', 'running', 'failed'],
+            defaults={'status': 'pending'}
+        )
+        if job.status == 'failed':
+            job.status = 'pending'
+            job.save(update_fields=['status', 'updated_at'])
+    return job
+
+
+def schedule_retention():
+    """Queue a purge for every active retention policy that has none pending"""
+    jobs = []
+    now = timezone.now()
+    for policy in RetentionPolicy.objects.filter(is_active=True):
+        if DeletionJob.objects.filter(kind='retention', room=policy.room,
+                                      status__in=['pending', 'running']).exists():
+            continue
+        jobs.append(DeletionJob.objects.create(
+            kind='retention', room=policy.room,
+            cutoff=now - timedelta(days=policy.max_age_days)
+        ))
+    return jobs
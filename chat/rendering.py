@@ -0,0 +1,116 @@
+"""
+Markdown rendering of message content, done once and stored with the message.
+
+New messages, and messages saved with content that differs from what was
+loaded from the database (see RenderedContentMixin), are rendered in
+pre_save and stored in ``content_html`` with the RENDER_VERSION that
+produced them. Reads use the stored HTML. A row rendered by an older
+renderer, or edited without going through save(), is stale: html_for() renders it on the fly through a bounded LRU, keyed on
+the content, so hot stale messages are rendered once per process.
+``manage.py rerender_messages`` brings stale rows up to date in batches in
+the background, so reads stop paying for them.
+
+Raw HTML in messages is escaped and only http(s), mailto and relative
+links are kept.
+"""
+import html
+import re
+import threading
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+import markdown
+from django.conf import settings
+from django.utils import timezone
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+
+
+# Bump whenever the output would change (extensions, sanitising, markdown
+# upgrades) so rerender_messages picks every stored row up again
+RENDER_VERSION = 2
+
+SAFE_SCHEMES = ('', 'http', 'https', 'mailto')
+
+# Browsers drop these from URLs before reading the scheme
+IGNORED_IN_URLS = re.compile(r'[\x00-\x20\x7f]+')
+
+_local = threading.local()
+_cached = None
+
+
+def is_safe_url(value):
+    """
+    Whether a link target is http(s), mailto or relative, read the way a
+    browser reads it: entities decoded (``javascript&colon;``) and
+    whitespace and control characters removed (``java\tscript:``).
+    """
+    value = IGNORED_IN_URLS.sub('', html.unescape(value))
+    try:
+        return urlsplit(value).scheme.lower() in SAFE_SCHEMES
+    except ValueError:
+        return False
+
+
+class SafeLinks(Treeprocessor):
+    """Drop href/src attributes with schemes such as javascript:"""
+
+    def run(self, root):
+        for element in root.iter():
+            for attribute in ('href', 'src'):
+                value = element.get(attribute)
+                if value is not None and not is_safe_url(value):
+                    del element.attrib[attribute]
+
+
+class ChatMarkdown(Extension):
+    def extendMarkdown(self, md):
+        # Escape raw HTML instead of passing it through
+        md.preprocessors.deregister('html_block')
+        md.inlinePatterns.deregister('html')
+        md.treeprocessors.register(SafeLinks(md), 'safe_links', 0)
+
+
+def _markdown():
+    # Markdown instances keep state between conversions and are not thread safe
+    try:
+        return _local.markdown
+    except AttributeError:
+        _local.markdown = markdown.Markdown(extensions=['fenced_code', 'sane_lists', 'nl2br', ChatMarkdown()])
+        return _local.markdown
+
+
+def render(text):
+    """HTML for ``text``, bypassing every cache"""
+    md = _markdown()
+    try:
+        return md.convert(text)
+    finally:
+        md.reset()
+
+
+def render_cached(text):
+    global _cached
+    if _cached is None:
+        _cached = lru_cache(maxsize=settings.CHAT_RENDER_CACHE_SIZE)(render)
+    return _cached(text)
+
+
+def is_stale(message):
+    if message.render_version != RENDER_VERSION or message.rendered_at is None:
+        return True
+    return message.edited_at is not None and message.edited_at > message.rendered_at
+
+
+def render_message(message):
+    """Render ``message`` into its stored fields; the caller saves it"""
+    message.content_html = render(message.content)
+    message.render_version = RENDER_VERSION
+    message.rendered_at = timezone.now()
+
+
+def html_for(message):
+    """The HTML for a message: stored if current, otherwise rendered through the LRU"""
+    if is_stale(message):
+        return render_cached(message.content)
+    return message.content_html
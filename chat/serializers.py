@@ -1,7 +1,13 @@
 from rest_framework import serializers
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
-from .models import UserProfile
+from .models import UserProfile, PublicChatHistory, PrivateMessage, GroupChatroom, GroupChatroomMember, GroupMessage, Mention
+from .profiles import profile_version
+from .rendering import html_for
+
+
+# Message types clients may post; system messages are only written by the server
+POSTABLE_MESSAGE_TYPES = [('text', 'Text'), ('image', 'Image'), ('file', 'File')]
 
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
@@ -24,10 +30,7 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         validated_data.pop('password_confirmation')
         password = validated_data.pop('password')
-        user = UserProfile.objects.create_user(**validated_data)
-        user.set_password(password)
-        user.save()
-        return user
+        return UserProfile.objects.create_user(password=password, **validated_data)
 
 
 class UserLoginSerializer(serializers.Serializer):
@@ -55,3 +58,144 @@ class UserProfileSerializer(serializers.ModelSerializer):
         model = UserProfile
         fields = ['id', 'username', 'email', 'display_name', 'avatar', 'status', 'bio', 'created_at']
         read_only_fields = ['id', 'created_at']
+
+
+class MessageAuthorSerializer(serializers.ModelSerializer):
+    version = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UserProfile
+        fields = ['id', 'username', 'display_name', 'avatar', 'version']
+
+    def get_version(self, obj):
+        return profile_version(obj)
+
+
+class UserDirectorySerializer(MessageAuthorSerializer):
+    """The cached public profile served by users/resolve/ (see chat/profiles.py)"""
+
+    class Meta(MessageAuthorSerializer.Meta):
+        fields = ['id', 'username', 'display_name', 'avatar', 'status', 'version']
+
+
+class CompactAuthorField(serializers.Field):
+    """An author as ``{"id", "version"}``, from the ``author_versions`` context"""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return {'id': value, 'version': self.context['author_versions'].get(value)}
+
+
+class AuthorVersionsMixin:
+    """
+    Pass ``author_versions`` (user id -> profile version) in the context to
+    send authors as ids and versions without loading the users
+    """
+    author_field = 'author'
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if self.context.get('author_versions') is not None:
+            fields[self.author_field] = CompactAuthorField(source=f'{self.author_field}_id')
+        return fields
+
+
+class PublicChatHistorySerializer(AuthorVersionsMixin, serializers.ModelSerializer):
+    author = MessageAuthorSerializer(read_only=True)
+    content_html = serializers.SerializerMethodField()
+    message_type = serializers.ChoiceField(choices=POSTABLE_MESSAGE_TYPES, default='text')
+
+    class Meta:
+        model = PublicChatHistory
+        fields = ['id', 'author', 'content', 'content_html', 'timestamp', 'edited', 'edited_at', 'message_type', 'reply_to']
+        read_only_fields = ['id', 'timestamp', 'edited', 'edited_at']
+
+    def get_content_html(self, obj):
+        return html_for(obj)
+
+
+class PrivateMessageSerializer(AuthorVersionsMixin, serializers.ModelSerializer):
+    author_field = 'sender'
+    sender = MessageAuthorSerializer(read_only=True)
+    content_html = serializers.SerializerMethodField()
+    message_type = serializers.ChoiceField(choices=POSTABLE_MESSAGE_TYPES, default='text')
+
+    class Meta:
+        model = PrivateMessage
+        fields = ['id', 'sender', 'receiver', 'content', 'content_html', 'timestamp', 'edited', 'edited_at',
+                  'message_type', 'is_read', 'read_at', 'reply_to']
+        read_only_fields = ['id', 'receiver', 'timestamp', 'edited', 'edited_at', 'is_read', 'read_at']
+
+    def get_content_html(self, obj):
+        return html_for(obj)
+
+
+class GroupMessageSerializer(AuthorVersionsMixin, serializers.ModelSerializer):
+    author = MessageAuthorSerializer(read_only=True)
+    content_html = serializers.SerializerMethodField()
+    message_type = serializers.ChoiceField(choices=POSTABLE_MESSAGE_TYPES, default='text')
+
+    class Meta:
+        model = GroupMessage
+        fields = ['id', 'group', 'author', 'content', 'content_html', 'timestamp', 'edited', 'edited_at', 'message_type', 'reply_to']
+        read_only_fields = ['id', 'group', 'timestamp', 'edited', 'edited_at']
+
+    def get_content_html(self, obj):
+        return html_for(obj)
+
+
+class GroupChatroomMemberSerializer(serializers.ModelSerializer):
+    user = MessageAuthorSerializer(read_only=True)
+
+    class Meta:
+        model = GroupChatroomMember
+        fields = ['group', 'user', 'role', 'is_active', 'joined_at', 'updated_at']
+
+
+class GroupDirectorySerializer(serializers.ModelSerializer):
+    """A room in the directory, with counters annotated from GroupStats"""
+    message_count = serializers.IntegerField(read_only=True)
+    member_count = serializers.IntegerField(read_only=True)
+    last_message_at = serializers.DateTimeField(read_only=True)
+    # Only present when sorting by trending
+    recent_messages = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = GroupChatroom
+        fields = ['id', 'name', 'description', 'avatar', 'created_at', 'max_participants',
+                  'message_count', 'member_count', 'last_message_at', 'recent_messages']
+
+
+class MentionSerializer(serializers.ModelSerializer):
+    """A mention with its message, which the view attaches as ``message``"""
+    room = serializers.SerializerMethodField()
+    message = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Mention
+        fields = ['id', 'room', 'message', 'is_read', 'created_at']
+
+    def get_room(self, obj):
+        return f'group:{obj.group_id}' if obj.group_id else 'public'
+
+    def get_message(self, obj):
+        if obj.message is None:
+            return None
+        if obj.group_id:
+            return GroupMessageSerializer(obj.message, context=self.context).data
+        return PublicChatHistorySerializer(obj.message, context=self.context).data
+
+
+class SyncCursorSerializer(serializers.Serializer):
+    after = serializers.IntegerField(min_value=0)
+    since = serializers.DateTimeField(required=False, allow_null=True)
+    # From edited_cursor, to continue a truncated list of edits
+    edited_after = serializers.IntegerField(required=False, allow_null=True, min_value=0)
+
+
+class SyncRequestSerializer(serializers.Serializer):
+    conversations = serializers.DictField(child=SyncCursorSerializer(), allow_empty=False)
+    since = serializers.DateTimeField(required=False, allow_null=True)
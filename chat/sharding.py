@@ -0,0 +1,194 @@
+"""
+Group-based sharding of group chat data across several databases.
+
+Each GroupChatroom is placed on one database alias. Its GroupMessage and
+GroupChatroomMember rows and the ChatFile/ChatImage rows attached to its
+messages live there; everything else stays on ``default``. The placement is
+recorded in the GroupShard table on ``default``. Groups without a row live
+on ``default``, so enabling sharding moves nothing by itself.
+
+Sharding is off unless CHAT_GROUP_SHARDS lists extra aliases. With it on:
+
+* GroupShardRouter sends reads and writes for the sharded models to the
+  right database whenever Django passes an instance hint: saves, related
+  managers such as ``group.messages``, and related-object access. Querysets
+  built from ``Model.objects`` carry no hint and must be pointed at a shard
+  explicitly with ``for_group()`` or spread over all databases with
+  ``fan_out()``.
+* Primary keys of the sharded models come from a shared sequence on
+  ``default`` (see allocate_id). That keeps ids unique everywhere, so rows
+  can move between shards and lookups by id can fan out.
+* Foreign keys that may cross databases have no database constraint, and
+  ``select_related`` across them is not possible. Use ``prefetch_related``.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+
+from .models import (
+    GroupChatroom, GroupChatroomMember, GroupMessage, ChatFile, ChatImage,
+    GroupShard, ShardSequence
+)
+
+
+SHARDED_MODELS = (GroupMessage, GroupChatroomMember, ChatFile, ChatImage)
+
+# Seconds a process trusts its cached copy of a group's route
+ROUTE_TTL = 5
+
+_routes = {}
+_id_blocks = {}
+_id_lock = threading.Lock()
+
+
+class GroupMoving(Exception):
+    """Raised for a write to a group that move_group is currently moving"""
+
+
+def enabled():
+    return bool(settings.CHAT_GROUP_SHARDS)
+
+
+def databases():
+    """Every alias that can hold group data"""
+    return [DEFAULT_DB_ALIAS] + [db for db in settings.CHAT_GROUP_SHARDS if db != DEFAULT_DB_ALIAS]
+
+
+def _route(group_id):
+    now = time.monotonic()
+    cached = _routes.get(group_id)
+    if cached and cached[2] > now:
+        return cached
+    row = GroupShard.objects.using(DEFAULT_DB_ALIAS).filter(
+        group_id=group_id
+    ).values_list('database', 'is_moving').first()
+    database, is_moving = row or (DEFAULT_DB_ALIAS, False)
+    _routes[group_id] = route = (database, is_moving, now + ROUTE_TTL)
+    return route
+
+
+def shard_for_group(group_id):
+    """Database alias holding the messages and members of ``group_id``"""
+    if not enabled() or group_id is None:
+        return DEFAULT_DB_ALIAS
+    return _route(group_id)[0]
+
+
+def check_writable(group_id):
+    """Raise GroupMoving while ``group_id`` is frozen for a move"""
+    if enabled() and _route(group_id)[1]:
+        raise GroupMoving(f'Group {group_id} is being moved; retry shortly')
+
+
+def forget_route(group_id):
+    _routes.pop(group_id, None)
+
+
+def for_group(model, group_id):
+    """``model`` rows of one group, read from that group's shard"""
+    return model._default_manager.using(shard_for_group(group_id)).filter(group_id=group_id)
+
+
+def group_databases(group_ids):
+    """Map database alias -> the given group ids that live there"""
+    placement = {}
+    for group_id in group_ids:
+        placement.setdefault(shard_for_group(group_id), []).append(group_id)
+    return placement
+
+
+def fan_out(queryset):
+    """The same query run against every database that can hold group data"""
+    if not enabled():
+        return [queryset]
+    return [queryset.using(db) for db in databases()]
+
+
+def find_by_pk(model, pk):
+    """Row ``pk`` of ``model`` from whichever database holds it; ids are unique across shards"""
+    for queryset in fan_out(model._default_manager.filter(pk=pk)):
+        found = list(queryset[:1])
+        if found:
+            return found[0]
+    raise model.DoesNotExist(f'{model.__name__} {pk} does not exist')
+
+
+def place_group(group):
+    """Choose a shard for a new group and record it"""
+    shards = settings.CHAT_GROUP_SHARDS
+    database = shards[group.pk % len(shards)]
+    GroupShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        group_id=group.pk, defaults={'database': database}
+    )
+    forget_route(group.pk)
+    return database
+
+
+def allocate_id(model):
+    """
+    Next primary key for a sharded model, from ShardSequence on ``default``.
+
+    One short transaction per CHAT_SHARD_ID_BLOCK ids; the rest of a block
+    is handed out from memory. Blocks above 1 make ids only time ordered
+    within a process, so a row written from an older block can land below
+    an id a cursor reader (poll, sync) has already passed. The default is 1.
+    """
+    with _id_lock:
+        cached = _id_blocks.get(model)
+        if cached and cached[0] < cached[1]:
+            cached[0] += 1
+            return cached[0] - 1
+
+    block = settings.CHAT_SHARD_ID_BLOCK
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        # get_or_create retries the lookup when another process creates the row first
+        sequence, created = ShardSequence.objects.using(DEFAULT_DB_ALIAS).select_for_update().get_or_create(
+            name=model._meta.label_lower,
+            defaults={'next_value': lambda: _highest_id(model) + 1},
+        )
+        start = sequence.next_value
+        sequence.next_value = start + block
+        sequence.save(using=DEFAULT_DB_ALIAS, update_fields=['next_value'])
+    with _id_lock:
+        _id_blocks[model] = [start + 1, start + block]
+    return start
+
+
+def _highest_id(model):
+    return max(
+        model._base_manager.using(db).aggregate(highest=Max('pk'))['highest'] or 0
+        for db in databases()
+    )
+
+
+class GroupShardRouter:
+    """Route the sharded models by the group of the instance hint"""
+
+    def _db(self, model, **hints):
+        if not enabled():
+            return None
+        if not issubclass(model, SHARDED_MODELS):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if isinstance(instance, GroupChatroom):
+            return shard_for_group(instance.pk)
+        if isinstance(instance, (GroupMessage, GroupChatroomMember)):
+            return shard_for_group(instance.group_id)
+        if isinstance(instance, (ChatFile, ChatImage)):
+            message = type(instance).group_message.field.get_cached_value(instance, None)
+            if message is not None:
+                return shard_for_group(message.group_id)
+        return instance._state.db
+
+    db_for_read = _db
+    db_for_write = _db
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if enabled() and (isinstance(obj1, SHARDED_MODELS) or isinstance(obj2, SHARDED_MODELS)):
+            return True
+        return None
@@ -0,0 +1,133 @@
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import mentions, metrics, profiles, rendering, sharding, stats
+from .conversations import channel_for_message
+from .models import (
+    UserProfile, PublicChatHistory, PrivateMessage,
+    GroupChatroom, GroupChatroomMember, GroupMessage, ChatFile, ChatImage, GroupStats
+)
+from .notifications import notifier
+
+
+@receiver(post_save, sender=PublicChatHistory)
+@receiver(post_save, sender=PrivateMessage)
+@receiver(post_save, sender=GroupMessage)
+def notify_new_message(sender, instance, created, raw=False, **kwargs):
+    """Wake long-poll requests parked on the message's room once the row is visible"""
+    if not created or raw:
+        return
+    channel = channel_for_message(instance)
+    transaction.on_commit(lambda: notifier.publish(channel), using=kwargs.get('using'))
+
+
+@receiver(pre_save, sender=GroupMessage)
+@receiver(pre_save, sender=GroupChatroomMember)
+@receiver(pre_save, sender=ChatFile)
+@receiver(pre_save, sender=ChatImage)
+def allocate_sharded_id(sender, instance, raw=False, **kwargs):
+    """Take ids for sharded rows from the shared sequence so they are unique on every shard"""
+    if sharding.enabled() and instance.pk is None and not raw:
+        instance.pk = sharding.allocate_id(sender)
+
+
+@receiver(pre_save, sender=PublicChatHistory)
+@receiver(pre_save, sender=PrivateMessage)
+@receiver(pre_save, sender=GroupMessage)
+def render_content(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Render Markdown on write so reads use the stored HTML"""
+    if raw or (update_fields is not None and 'content' not in update_fields):
+        return
+    if instance._state.adding or instance.content_changed() or rendering.is_stale(instance):
+        rendering.render_message(instance)
+
+
+@receiver(post_save, sender=GroupChatroom)
+def place_new_group(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and sharding.enabled():
+        sharding.place_group(instance)
+
+
+@receiver(post_save, sender=GroupChatroom)
+def create_group_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        GroupStats.objects.get_or_create(group=instance)
+
+
+@receiver(post_save, sender=GroupMessage)
+def count_new_group_message(sender, instance, created, raw=False, **kwargs):
+    # raw saves are move_group copying rows that are already counted
+    if created and not raw:
+        transaction.on_commit(lambda: stats.record_message(instance), using=kwargs.get('using'))
+
+
+@receiver(post_delete, sender=GroupMessage)
+def count_deleted_group_message(sender, instance, **kwargs):
+    group_id, message_id, timestamp = instance.group_id, instance.pk, instance.timestamp
+    transaction.on_commit(lambda: stats.forget_message(group_id, message_id, timestamp), using=kwargs.get('using'))
+
+
+@receiver(post_save, sender=GroupChatroomMember)
+@receiver(post_delete, sender=GroupChatroomMember)
+def count_group_members(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: stats.refresh_member_count(instance.group_id), using=kwargs.get('using'))
+
+
+@receiver(pre_delete, sender=GroupChatroom)
+def delete_sharded_group_rows(sender, instance, **kwargs):
+    """The ORM only cascades within one database, so clear the group's shard by hand"""
+    database = sharding.shard_for_group(instance.pk)
+    if database != kwargs.get('using'):
+        for model in (GroupMessage, GroupChatroomMember):
+            model.objects.using(database).filter(group_id=instance.pk).delete()
+
+
+@receiver(pre_delete, sender=UserProfile)
+def delete_sharded_user_rows(sender, instance, **kwargs):
+    if not sharding.enabled():
+        return
+    for database in sharding.databases():
+        if database == kwargs.get('using'):
+            continue
+        ChatFile.objects.using(database).filter(uploaded_by_id=instance.pk).delete()
+        ChatImage.objects.using(database).filter(uploaded_by_id=instance.pk).delete()
+        GroupMessage.objects.using(database).filter(author_id=instance.pk).delete()
+        GroupChatroomMember.objects.using(database).filter(user_id=instance.pk).delete()
+
+
+@receiver(post_save, sender=PublicChatHistory)
+@receiver(post_save, sender=GroupMessage)
+def parse_mentions(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # Saves that leave the text alone (read flags, re-rendering) keep their mentions
+    if raw or (update_fields is not None and 'content' not in update_fields):
+        return
+    if created or instance.content_changed():
+        transaction.on_commit(lambda: mentions.sync_mentions(instance, created), using=kwargs.get('using'))
+
+
+@receiver(post_delete, sender=GroupMessage)
+def delete_sharded_mentions(sender, instance, using, **kwargs):
+    # Mentions live on default; the ORM only cascades to them there
+    if using != DEFAULT_DB_ALIAS:
+        message_id = instance.pk
+        transaction.on_commit(lambda: mentions.forget_mentions(sender, message_id), using=using)
+
+
+@receiver(post_save, sender=UserProfile)
+def refresh_profile_version(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: profiles.profile_changed(instance), using=kwargs.get('using'))
+
+
+@receiver(post_delete, sender=UserProfile)
+def forget_profile_version(sender, instance, **kwargs):
+    user_id = instance.pk
+    transaction.on_commit(lambda: profiles.profile_deleted(user_id), using=kwargs.get('using'))
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    metrics.install_query_timer(connection)
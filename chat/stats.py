@@ -0,0 +1,112 @@
+"""
+Per-group statistics kept up to date as messages and memberships change.
+
+GroupStats holds one row per group with its message count, active member
+count and last activity; GroupActivity counts messages per group per hour
+(UTC) for trending rooms. Both live on ``default`` and are updated from
+signal handlers with single UPDATE statements once the triggering write has
+committed, so reading them never touches the message tables.
+
+Deleting a message takes it off both, and moves last_message_* back to
+the message before it when it was the newest. The counters drift only
+where writes bypass the signals (queryset.update(), raw SQL);
+``manage.py rebuild_group_stats`` recomputes everything from the messages
+and members themselves.
+"""
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Max, Value
+from django.db.models.functions import Coalesce, Greatest, TruncHour
+from django.utils import timezone
+
+from .models import GroupChatroomMember, GroupMessage, GroupStats, GroupActivity
+from .sharding import for_group
+
+
+def activity_hour(moment):
+    """Start of the UTC hour containing ``moment``"""
+    return moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def _increment(model, lookup, **changes):
+    """UPDATE the row matching ``lookup``, inserting it first if it is missing"""
+    if model.objects.filter(**lookup).update(**changes):
+        return
+    model.objects.bulk_create([model(**lookup)], ignore_conflicts=True)
+    model.objects.filter(**lookup).update(**changes)
+
+
+def record_message(message):
+    _increment(
+        GroupStats, {'group_id': message.group_id},
+        message_count=F('message_count') + 1,
+        # Coalesce: GREATEST is NULL if any argument is, except on PostgreSQL
+        last_message_id=Greatest(Coalesce(F('last_message_id'), Value(message.pk)), Value(message.pk)),
+        last_message_at=Greatest(Coalesce(F('last_message_at'), Value(message.timestamp)), Value(message.timestamp)),
+    )
+    _increment(
+        GroupActivity, {'group_id': message.group_id, 'hour': activity_hour(message.timestamp)},
+        message_count=F('message_count') + 1,
+    )
+
+
+def forget_message(group_id, message_id, timestamp):
+    """Take a deleted message off the counters; the instance has lost its pk by commit time"""
+    with transaction.atomic():
+        GroupStats.objects.filter(group_id=group_id, message_count__gt=0).update(
+            message_count=F('message_count') - 1
+        )
+        GroupActivity.objects.filter(
+            group_id=group_id, hour=activity_hour(timestamp), message_count__gt=0
+        ).update(message_count=F('message_count') - 1)
+    if GroupStats.objects.filter(group_id=group_id, last_message_id=message_id).exists():
+        # The newest message went; fall back to the one before it
+        latest = for_group(GroupMessage, group_id).order_by('-pk').values('pk', 'timestamp').first()
+        GroupStats.objects.filter(group_id=group_id, last_message_id=message_id).update(
+            last_message_id=latest and latest['pk'],
+            last_message_at=latest and latest['timestamp'],
+        )
+
+
+def refresh_member_count(group_id):
+    """Recount active members; membership writes are rare enough to count exactly"""
+    count = for_group(GroupChatroomMember, group_id).filter(is_active=True).count()
+    GroupStats.objects.filter(group_id=group_id).update(member_count=count)
+
+
+def rebuild(group_id, since=None):
+    """
+    Recompute the stats row of ``group_id`` and its activity buckets from
+    ``since`` onwards (default: CHAT_ACTIVITY_RETENTION_DAYS ago)
+    """
+    if since is None:
+        since = timezone.now() - timedelta(days=settings.CHAT_ACTIVITY_RETENTION_DAYS)
+    since = activity_hour(since)
+    messages = for_group(GroupMessage, group_id)
+    totals = messages.aggregate(count=Count('pk'), last_id=Max('pk'), last_at=Max('timestamp'))
+    members = for_group(GroupChatroomMember, group_id).filter(is_active=True).count()
+    buckets = messages.filter(timestamp__gte=since).annotate(
+        bucket=TruncHour('timestamp', tzinfo=dt_timezone.utc)
+    ).values('bucket').annotate(count=Count('pk')).order_by()
+
+    with transaction.atomic():
+        GroupStats.objects.update_or_create(group_id=group_id, defaults={
+            'message_count': totals['count'],
+            'member_count': members,
+            'last_message_id': totals['last_id'],
+            'last_message_at': totals['last_at'],
+        })
+        GroupActivity.objects.filter(group_id=group_id, hour__gte=since).delete()
+        GroupActivity.objects.bulk_create([
+            GroupActivity(group_id=group_id, hour=row['bucket'], message_count=row['count'])
+            for row in buckets
+        ])
+
+
+def prune_activity(now=None):
+    """Drop activity buckets older than CHAT_ACTIVITY_RETENTION_DAYS; returns rows deleted"""
+    cutoff = (now or timezone.now()) - timedelta(days=settings.CHAT_ACTIVITY_RETENTION_DAYS)
+    deleted, _ = GroupActivity.objects.filter(hour__lt=activity_hour(cutoff)).delete()
+    return deleted
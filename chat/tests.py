@@ -1,3 +1,939 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from . import metrics, sharding
+from .management.commands import move_group
+from .fields import MARKER, PackedText, pack, unpack
+from .models import (
+    UserProfile, PublicChatHistory, PrivateMessage, GroupChatroom, GroupChatroomMember, GroupMessage,
+    ChatFile, ChatImage, ShardSequence, DeletionJob, Mention, GroupStats, GroupActivity
+)
+from .metrics import RETIRED, exposition, registry
+from .notifications import notifier
+from .purge import JobTaken, claim_job, delete_batch, run_job, schedule_user_deletion
+from .stats import activity_hour
+from .rendering import RENDER_VERSION, render
+from .throttling import flood_control
+
+
+class ChatTestCase(TestCase):
+    """Runs on every database, so the same tests cover sharded group data when CHAT_SHARDS is set"""
+    databases = '__all__'
+
+    def setUp(self):
+        # Routes, id blocks and profile versions cached by this process outlive the rolled back rows
+        sharding._routes.clear()
+        sharding._id_blocks.clear()
+        caches[settings.CHAT_PROFILE_CACHE].clear()
+
+
+def api_client(user):
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.create(user=user).key)
+    return client
+
+
+class RenderingTests(ChatTestCase):
+    """Markdown rendering and link sanitising"""
+
+    UNSAFE_LINKS = [
+        '[x](javascript:alert(1))',
+        '[x](JaVaScRiPt:alert(1))',
+        '[x](javascript&colon;alert(document.cookie))',
+        '[x](javascript&#58;alert(1))',
+        '[x](javascript&#x3A;alert(1))',
+        '[x](&#x6A;avascript:alert(1))',
+        '[x](java\tscript:alert(1))',
+        '[x](java&#9;script:alert(1))',
+        '[x](java&NewLine;script:alert(1))',
+        '[x](vbscript:msgbox(1))',
+        '![x](data:image/svg+xml;base64,PHN2Zz4=)',
+    ]
+
+    def test_unsafe_links_are_dropped(self):
+        for text in self.UNSAFE_LINKS:
+            with self.subTest(text=text):
+                html = render(text)
+                self.assertNotIn('href', html)
+                self.assertNotIn('src', html)
+
+    def test_safe_links_are_kept(self):
+        self.assertIn('href="https://example.com/a?b=1&amp;c=2"', render('[x](https://example.com/a?b=1&c=2)'))
+        self.assertIn('href="mailto:bob@example.com"', render('[x](mailto:bob@example.com)'))
+        self.assertIn('href="/api/chat/"', render('[x](/api/chat/)'))
+
+    def test_raw_html_is_escaped(self):
+        self.assertNotIn('<script', render('<script>alert(1)</script>'))
+
+    def test_posted_message_is_sanitised(self):
+        bob = UserProfile.objects.create_user('bob')
+        response = api_client(bob).post('/api/chat/messages/public/', {
+            'content': '[x](javascript&colon;alert(document.cookie))'
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('href', response.data['content_html'])
+        self.assertNotIn('href', PublicChatHistory.objects.get().content_html)
+
+
+class StoredRenderTests(ChatTestCase):
+    """content_html follows content however the message is saved"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = UserProfile.objects.create_user('alice')
+        self.message = PublicChatHistory.objects.create(author=self.user, content='old *text*')
+
+    def stored_html(self):
+        return PublicChatHistory.objects.values_list('content_html', flat=True).get(pk=self.message.pk)
+
+    def test_new_message_is_rendered(self):
+        self.assertEqual(self.stored_html(), '<p>old <em>text</em></p>')
+        self.assertEqual(self.message.render_version, RENDER_VERSION)
+
+    def test_changed_content_is_rendered_without_edited_at(self):
+        message = PublicChatHistory.objects.get(pk=self.message.pk)
+        message.content = 'new _text_'
+        message.save()
+        self.assertEqual(str(self.stored_html()), '<p>new <em>text</em></p>')
+
+    def test_update_fields_save_stores_the_html(self):
+        message = PublicChatHistory.objects.get(pk=self.message.pk)
+        message.content = 'new **text**'
+        message.save(update_fields=['content'])
+        self.assertEqual(str(self.stored_html()), '<p>new <strong>text</strong></p>')
+
+    def test_unchanged_content_is_not_rendered_again(self):
+        message = PublicChatHistory.objects.get(pk=self.message.pk)
+        rendered_at = message.rendered_at
+        message.edited = True
+        message.save()
+        message.refresh_from_db()
+        self.assertEqual(message.rendered_at, rendered_at)
+
+    def test_compressed_content(self):
+        content = 'long *text* ' * 200
+        message = PublicChatHistory.objects.create(author=self.user, content=content)
+        message = PublicChatHistory.objects.get(pk=message.pk)
+        message.save()
+        message.content = content + 'more'
+        message.save()
+        message.refresh_from_db()
+        self.assertTrue(message.content_html.endswith('more</p>'))
+
+
+class PollTests(ChatTestCase):
+    """poll_messages cursors and argument checks"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = UserProfile.objects.create_user('alice')
+        self.client = api_client(self.user)
+        self.first = PublicChatHistory.objects.create(author=self.user, content='one')
+        self.second = PublicChatHistory.objects.create(author=self.user, content='two')
+
+    def poll(self, rooms, timeout=0):
+        return self.client.get('/api/chat/messages/poll/', {'rooms': rooms, 'timeout': timeout})
+
+    def test_returns_messages_after_the_cursor(self):
+        response = self.poll(f'public:{self.first.pk}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in response.json()['rooms']['public']], [self.second.pk])
+        self.assertEqual(response.json()['cursors'], {'public': self.second.pk})
+
+    def test_cursor_is_kept_when_nothing_is_new(self):
+        response = self.poll(f'public:{self.second.pk}')
+        self.assertEqual(response.json(), {'rooms': {}, 'cursors': {'public': self.second.pk}})
+
+    def test_non_finite_timeout_is_rejected(self):
+        for timeout in ('nan', 'inf', '-inf'):
+            with self.subTest(timeout=timeout):
+                self.assertEqual(self.poll('public:0', timeout).status_code, 400)
+
+    def test_invalid_cursor_is_rejected(self):
+        self.assertEqual(self.poll('public:x').status_code, 400)
+        self.assertEqual(self.poll('group:abc:1').status_code, 400)
+
+    def test_requires_authentication(self):
+        response = APIClient().get('/api/chat/messages/poll/', {'rooms': 'public:0'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_a_write_wakes_a_parked_poll(self):
+        token = await Token.objects.aget(user=self.user)
+        started = time.monotonic()
+        poll = asyncio.ensure_future(self.async_client.get(
+            '/api/chat/messages/poll/', {'rooms': f'public:{self.second.pk}', 'timeout': 30},
+            headers={'Authorization': f'Token {token.key}'},
+        ))
+        while not notifier.waiting:
+            self.assertFalse(poll.done())
+            await asyncio.sleep(0.01)
+
+        def write():
+            with self.captureOnCommitCallbacks(execute=True):
+                return PublicChatHistory.objects.create(author=self.user, content='three')
+
+        third = await sync_to_async(write)()
+        response = await asyncio.wait_for(poll, 5)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([m['id'] for m in response.json()['rooms']['public']], [third.pk])
+        self.assertEqual(notifier.waiting, 0)
+
+
+class PostMessageTests(ChatTestCase):
+    """post_message validation and flood control"""
+
+    def setUp(self):
+        super().setUp()
+        # Start every test with empty buckets
+        flood_control._config = None
+        self.user = UserProfile.objects.create_user('bob')
+        self.client = api_client(self.user)
+
+    def tearDown(self):
+        flood_control._config = None
+
+    def post(self, **data):
+        return self.client.post('/api/chat/messages/public/', {'content': 'hi', **data}, format='json')
+
+    def test_post_message(self):
+        response = self.post(message_type='file')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['message_type'], 'file')
+        self.assertEqual(response.data['author']['id'], self.user.pk)
+
+    def test_clients_cannot_post_system_messages(self):
+        response = self.post(message_type='system')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('message_type', response.data)
+        self.assertFalse(PublicChatHistory.objects.exists())
+
+    def test_system_messages_are_still_listed(self):
+        message = PublicChatHistory.objects.create(author=self.user, content='joined', message_type='system')
+        response = self.client.get('/api/chat/messages/poll/', {'rooms': f'public:{message.pk - 1}', 'timeout': 0})
+        self.assertEqual(response.json()['rooms']['public'][0]['message_type'], 'system')
+
+    @override_settings(CHAT_FLOOD_CONTROL={
+        'BACKEND': 'local', 'USER_RATES': {'admin': '5/min', 'member': '2/min'}, 'ROOM_RATE': '100/min'
+    })
+    def test_flooding_is_throttled(self):
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(self.post().status_code, 201)
+        response = self.post()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(PublicChatHistory.objects.count(), 2)
+        self.assertEqual(flood_control.stats()['users'], [{'user': self.user.pk, 'count': 1}])
+
+    @override_settings(CHAT_FLOOD_CONTROL={
+        'BACKEND': 'local', 'USER_RATES': {'member': '100/min'}, 'ROOM_RATE': '1/min'
+    })
+    def test_room_budget_is_shared(self):
+        other = api_client(UserProfile.objects.create_user('carol'))
+        self.assertEqual(self.post().status_code, 201)
+        response = other.post('/api/chat/messages/public/', {'content': 'hi'}, format='json')
+        self.assertEqual(response.status_code, 429)
+
+
+@override_settings(CHAT_SYNC_BATCH_SIZE=2)
+class SyncTests(ChatTestCase):
+    """sync_conversations cursors, paging and unavailable rooms"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = UserProfile.objects.create_user('alice')
+        self.other = UserProfile.objects.create_user('bob')
+        self.client = api_client(self.user)
+        self.group = GroupChatroom.objects.create(name='room', created_by=self.other)
+        GroupChatroomMember.objects.create(group=self.group, user=self.user)
+        self.messages = [
+            GroupMessage.objects.create(group=self.group, author=self.other, content=f'm{n}') for n in range(5)
+        ]
+
+    def sync(self, conversations, since=None):
+        return self.client.post('/api/chat/messages/sync/', {
+            'since': since, 'conversations': conversations
+        }, format='json')
+
+    def test_new_messages_page_by_id(self):
+        key = f'group:{self.group.pk}'
+        seen, after = [], 0
+        while True:
+            result = self.sync({key: {'after': after}}).data['conversations'][key]
+            seen += [m['id'] for m in result['messages']]
+            after = seen[-1]
+            if not result['has_more']:
+                break
+        self.assertEqual(seen, [m.pk for m in self.messages])
+
+    def test_truncated_edits_are_paged_with_a_cursor(self):
+        key = f'group:{self.group.pk}'
+        since = self.sync({key: {'after': self.messages[-1].pk}}).data['server_time']
+        edited_at = timezone.now() + timedelta(seconds=1)
+        # Three edits at the same instant straddle the page boundary
+        for n, message in enumerate(self.messages):
+            sharding.for_group(GroupMessage, self.group.pk).filter(pk=message.pk).update(
+                content=f'edited {n}', edited_at=edited_at + timedelta(seconds=n // 3)
+            )
+
+        cursor = {'after': self.messages[-1].pk, 'since': since}
+        seen = []
+        while True:
+            result = self.sync({key: cursor}).data['conversations'][key]
+            seen += [m['id'] for m in result['edited']]
+            if not result['edited_has_more']:
+                break
+            cursor = {'after': self.messages[-1].pk, **result['edited_cursor']}
+        self.assertEqual(sorted(seen), [m.pk for m in self.messages])
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_unavailable_rooms_do_not_fail_the_sync(self):
+        self.other.is_active = False
+        self.other.save()
+        closed = GroupChatroom.objects.create(name='closed', created_by=self.other)
+        response = self.sync({
+            'public': {'after': 0},
+            f'private:{self.other.pk}': {'after': 0},
+            f'group:{closed.pk}': {'after': 0},
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data['conversations']), ['public'])
+        self.assertEqual(set(response.data['unavailable']), {f'private:{self.other.pk}', f'group:{closed.pk}'})
+
+    def test_malformed_key_is_rejected(self):
+        self.assertEqual(self.sync({'group:x': {'after': 0}}).status_code, 400)
+
+    def test_private_messages_and_membership_changes(self):
+        since = self.sync({'public': {'after': 0}}).data['server_time']
+        PrivateMessage.objects.create(sender=self.other, receiver=self.user, content='hi')
+        GroupChatroomMember.objects.create(group=self.group, user=self.other)
+        key = f'group:{self.group.pk}'
+        response = self.sync({
+            f'private:{self.other.pk}': {'after': 0},
+            key: {'after': self.messages[-1].pk},
+        }, since=since)
+        private = response.data['conversations'][f'private:{self.other.pk}']
+        self.assertEqual([m['content'] for m in private['messages']], ['hi'])
+        self.assertEqual([m['user']['id'] for m in response.data['conversations'][key]['members']], [self.other.pk])
+
+
+@skipUnless(settings.CHAT_GROUP_SHARDS, 'run with CHAT_SHARDS=2 to test sharding')
+class ShardingTests(ChatTestCase):
+    """Placement, id allocation and moves of sharded group data"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = UserProfile.objects.create_user('alice')
+        self.client = api_client(self.user)
+        self.group = GroupChatroom.objects.create(name='room', created_by=self.user)
+        self.shard = sharding.shard_for_group(self.group.pk)
+
+    def test_group_rows_are_written_to_the_shard(self):
+        GroupChatroomMember.objects.create(group=self.group, user=self.user)
+        response = self.client.post(f'/api/chat/messages/group:{self.group.pk}/', {'content': 'hi'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertNotEqual(self.shard, 'default')
+        self.assertTrue(GroupMessage.objects.using(self.shard).filter(pk=response.data['id']).exists())
+        self.assertFalse(GroupMessage.objects.using('default').exists())
+
+    @override_settings(CHAT_SHARD_ID_BLOCK=10)
+    def test_ids_are_reserved_in_blocks(self):
+        messages = [GroupMessage.objects.create(group=self.group, author=self.user, content='m') for _ in range(15)]
+        self.assertEqual([m.pk for m in messages], list(range(1, 16)))
+        self.assertEqual(ShardSequence.objects.get(name='chat.groupmessage').next_value, 21)
+
+    def test_get_or_create_and_update_or_create_use_the_shard(self):
+        member, created = GroupChatroomMember.objects.get_or_create(group=self.group, user=self.user)
+        self.assertTrue(created)
+        self.assertEqual(member._state.db, self.shard)
+        again, created = GroupChatroomMember.objects.get_or_create(group=self.group, user=self.user)
+        self.assertEqual((again.pk, created), (member.pk, False))
+        updated, created = GroupChatroomMember.objects.update_or_create(
+            group=self.group, user=self.user, defaults={'role': 'admin'}
+        )
+        self.assertEqual((updated.pk, updated.role, created), (member.pk, 'admin', False))
+        self.assertEqual(GroupChatroomMember.objects.using(self.shard).get().role, 'admin')
+        self.assertFalse(GroupChatroomMember.objects.using('default').exists())
+
+    def test_move_group(self):
+        GroupChatroomMember.objects.create(group=self.group, user=self.user)
+        first = GroupMessage.objects.create(group=self.group, author=self.user, content='first')
+        reply = GroupMessage.objects.create(group=self.group, author=self.user, content='reply', reply_to=first)
+        attachment = ChatFile.objects.create(
+            file='chat_files/a.txt', original_name='a.txt', file_size=1, file_type='text/plain',
+            uploaded_by=self.user, group_message=first
+        )
+        target = next(db for db in settings.CHAT_GROUP_SHARDS if db != self.shard)
+
+        with mock.patch.object(sharding, 'ROUTE_TTL', 0):
+            call_command('move_group', str(self.group.pk), target, stdout=StringIO())
+
+        self.assertEqual(sharding.shard_for_group(self.group.pk), target)
+        moved = GroupMessage.objects.using(target).get(pk=reply.pk)
+        self.assertEqual((moved.reply_to_id, moved.timestamp), (first.pk, reply.timestamp))
+        self.assertTrue(ChatFile.objects.using(target).filter(pk=attachment.pk).exists())
+        for model in (GroupMessage, GroupChatroomMember, ChatFile):
+            self.assertFalse(model.objects.using(self.shard).exists())
+        response = self.client.get('/api/chat/messages/poll/', {'rooms': f'group:{self.group.pk}:0', 'timeout': 0})
+        self.assertEqual([m['id'] for m in response.json()['rooms'][f'group:{self.group.pk}']], [first.pk, reply.pk])
+
+    def test_move_group_keeps_lower_ids_written_during_the_copy(self):
+        # Another process writing from an older id block lands below ids already copied
+        for pk in (10, 20):
+            GroupMessage(pk=pk, group=self.group, author=self.user, content=f'm{pk}').save()
+        target = next(db for db in settings.CHAT_GROUP_SHARDS if db != self.shard)
+        bulk_copy = move_group.Command.copy
+
+        def copy(command, group_id, source, target, **kwargs):
+            bulk_copy(command, group_id, source, target, **kwargs)
+            if not kwargs:
+                GroupMessage(pk=15, group=self.group, author=self.user, content='late').save()
+
+        with mock.patch.object(sharding, 'ROUTE_TTL', 0), mock.patch.object(move_group.Command, 'copy', copy):
+            call_command('move_group', str(self.group.pk), target, stdout=StringIO())
+
+        self.assertEqual(list(GroupMessage.objects.using(target).values_list('pk', flat=True).order_by('pk')), [10, 15, 20])
+        self.assertFalse(GroupMessage.objects.using(self.shard).exists())
+
+
+class DeletionTests(ChatTestCase):
+    """Batched user removal through process_deletions"""
+
+    def setUp(self):
+        super().setUp()
+        self.alice = UserProfile.objects.create_user('alice')
+        self.bob = UserProfile.objects.create_user('bob')
+        self.group = GroupChatroom.objects.create(name='room', created_by=self.alice)
+        for user in (self.alice, self.bob):
+            PublicChatHistory.objects.create(author=user, content='hi')
+            GroupChatroomMember.objects.create(group=self.group, user=user)
+            GroupMessage.objects.create(group=self.group, author=user, content='hi')
+        self.jobs = [schedule_user_deletion(user) for user in (self.alice, self.bob)]
+
+    def process(self):
+        call_command('process_deletions', pause=0, batch_size=1, stdout=StringIO(), stderr=StringIO())
+
+    def test_removes_users_and_their_data(self):
+        self.process()
+        self.assertFalse(UserProfile.objects.exists())
+        self.assertFalse(PublicChatHistory.objects.exists())
+        self.assertFalse(GroupChatroom.objects.exists())
+        for database in sharding.databases():
+            self.assertFalse(GroupMessage.objects.using(database).exists())
+        self.assertEqual(set(DeletionJob.objects.values_list('status', flat=True)), {'done'})
+
+    def test_a_failing_job_does_not_stop_the_others(self):
+        calls = []
+
+        def fail_first(queryset, batch_size):
+            calls.append(queryset)
+            if len(calls) == 1:
+                raise RuntimeError('disk on fire')
+            return delete_batch(queryset, batch_size)
+
+        with mock.patch('chat.purge.delete_batch', side_effect=fail_first):
+            with self.assertRaisesMessage(CommandError, '1 deletion job(s) failed'):
+                self.process()
+
+        first, second = DeletionJob.objects.order_by('created_at', 'pk')
+        self.assertEqual((first.status, first.error), ('failed', 'disk on fire'))
+        self.assertEqual(second.status, 'done')
+        self.assertFalse(UserProfile.objects.filter(pk=self.bob.pk).exists())
+        self.assertTrue(UserProfile.objects.filter(pk=self.alice.pk).exists())
+
+    def test_jobs_are_claimed_once(self):
+        job = self.jobs[0]
+        self.assertTrue(claim_job(job))
+        self.assertEqual(job.status, 'running')
+        self.assertFalse(claim_job(DeletionJob.objects.get(pk=job.pk)))
+        with self.assertRaises(JobTaken):
+            run_job(DeletionJob.objects.get(pk=job.pk), pause=0)
+
+    def test_running_jobs_are_left_to_their_worker_until_stale(self):
+        first, second = self.jobs
+        DeletionJob.objects.filter(pk=first.pk).update(status='running', stage='public_messages', rows_deleted=3)
+        self.process()
+        self.assertEqual(DeletionJob.objects.get(pk=first.pk).status, 'running')
+        self.assertTrue(UserProfile.objects.filter(pk=self.alice.pk).exists())
+        self.assertEqual(DeletionJob.objects.get(pk=second.pk).status, 'done')
+
+        stale = timezone.now() - timedelta(seconds=settings.CHAT_DELETION_STALE_AFTER + 1)
+        DeletionJob.objects.filter(pk=first.pk).update(updated_at=stale)
+        self.process()
+        first.refresh_from_db()
+        self.assertEqual(first.status, 'done')
+        # Resumed from the recorded progress rather than the stale instance's
+        self.assertGreater(first.rows_deleted, 3)
+        self.assertFalse(UserProfile.objects.filter(pk=self.alice.pk).exists())
+
+
+class MetricsTests(ChatTestCase):
+    """Access to the metrics endpoint and aggregation across worker processes"""
+
+    def setUp(self):
+        super().setUp()
+        self.staff = UserProfile.objects.create_user('admin', is_staff=True)
+        self.user = UserProfile.objects.create_user('bob')
+
+    def scrape(self, client=None, **headers):
+        return (client or APIClient()).get('/api/chat/metrics/', **headers)
+
+    def test_local_requests_are_not_trusted(self):
+        self.assertEqual(self.scrape(REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.scrape(api_client(self.user)).status_code, 403)
+
+    def test_staff_may_scrape(self):
+        response = self.scrape(api_client(self.staff))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_http_requests_total counter', response.content)
+
+    @override_settings(CHAT_METRICS_TOKEN='s3cret')
+    def test_bearer_token(self):
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+        self.assertEqual(self.scrape(HTTP_AUTHORIZATION='Bearer guess').status_code, 403)
+
+    def worker_file(self, directory, pid, count):
+        with open(os.path.join(directory, f'{pid}.json'), 'w') as f:
+            json.dump({
+                'pid': pid,
+                'counters': [['chat_flood_control_checks_total', [], count]],
+                'histograms': [],
+                'gauges': [['chat_long_poll_waiting', [], 7]],
+            }, f)
+
+    @skipUnless(metrics.fcntl, 'retiring worker files needs fcntl')
+    def test_exited_workers_are_folded_into_retired_totals(self):
+        # Far above any pid_max, so never a live process
+        exited = 2 ** 30
+        with tempfile.TemporaryDirectory() as directory, override_settings(CHAT_METRICS_DIR=directory):
+            self.worker_file(directory, exited, 5)
+            self.worker_file(directory, exited + 1, 3)
+            own = registry.snapshot()['counters']
+            text = exposition(registry.collect())
+            self.assertEqual(sorted(os.listdir(directory)), [RETIRED, 'retired.lock'])
+
+            self.worker_file(directory, exited + 2, 1)
+            again = exposition(registry.collect())
+            self.assertEqual(sorted(os.listdir(directory)), [RETIRED, 'retired.lock'])
+
+        checked = next(value for name, _, value in own if name == 'chat_flood_control_checks_total')
+        self.assertIn(f'chat_flood_control_checks_total {checked + 8}\n', text)
+        self.assertIn(f'chat_flood_control_checks_total {checked + 9}\n', again)
+        self.assertNotIn('chat_long_poll_waiting 7', text)
+
+    def test_without_fcntl_worker_files_are_summed_and_kept(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(CHAT_METRICS_DIR=directory), \
+                mock.patch.object(metrics, 'fcntl', None), mock.patch.object(metrics, '_alive') as alive:
+            self.worker_file(directory, 2 ** 30, 5)
+            own = registry.snapshot()['counters']
+            text = exposition(registry.collect())
+            self.assertEqual(os.listdir(directory), [f'{2 ** 30}.json'])
+        alive.assert_not_called()
+        checked = next(value for name, _, value in own if name == 'chat_flood_control_checks_total')
+        self.assertIn(f'chat_flood_control_checks_total {checked + 5}\n', text)
+
+
+class MentionTests(ChatTestCase):
+    """Mentions follow message edits and feed mentions/"""
+
+    def setUp(self):
+        super().setUp()
+        self.alice = UserProfile.objects.create_user('alice')
+        self.bob = UserProfile.objects.create_user('bob')
+        self.carol = UserProfile.objects.create_user('carol')
+        self.group = GroupChatroom.objects.create(name='room', created_by=self.alice)
+        for user in (self.alice, self.bob):
+            GroupChatroomMember.objects.create(group=self.group, user=user)
+
+    def post(self, model, content, group=None):
+        # The handlers run on commit of the database the message is written to
+        database = sharding.shard_for_group(group.pk) if group else 'default'
+        with self.captureOnCommitCallbacks(using=database, execute=True):
+            if group:
+                return model.objects.create(author=self.alice, content=content, group=group)
+            return model.objects.create(author=self.alice, content=content)
+
+    def save(self, message, **kwargs):
+        with self.captureOnCommitCallbacks(using=message._state.db, execute=True) as callbacks:
+            message.save(**kwargs)
+        return callbacks
+
+    def mentioned(self, **lookup):
+        return set(Mention.objects.filter(**lookup).values_list('user__username', flat=True))
+
+    def test_edits_add_and_remove_mentions(self):
+        message = self.post(PublicChatHistory, 'hi @bob and @alice')
+        self.assertEqual(self.mentioned(public_message=message), {'bob'})
+        message.content = 'hi @carol.'
+        self.save(message)
+        self.assertEqual(self.mentioned(public_message=message), {'carol'})
+        message.content = 'nobody'
+        self.save(message, update_fields=['content'])
+        self.assertEqual(self.mentioned(public_message=message), set())
+
+    def test_group_mentions_are_limited_to_members(self):
+        message = self.post(GroupMessage, '@bob @carol', group=self.group)
+        self.assertEqual(self.mentioned(group_message_id=message.pk), {'bob'})
+
+    def test_deleting_a_message_deletes_its_mentions(self):
+        message = self.post(GroupMessage, 'ping @bob', group=self.group)
+        self.assertTrue(Mention.objects.exists())
+        with self.captureOnCommitCallbacks(using=message._state.db, execute=True):
+            message.delete()
+        self.assertFalse(Mention.objects.exists())
+
+    def test_saves_that_keep_the_content_do_not_reparse(self):
+        message = self.post(PublicChatHistory, 'hi @bob')
+        message = PublicChatHistory.objects.get(pk=message.pk)
+        message.edited = True
+        self.assertEqual(self.save(message), [])
+        self.assertEqual(self.save(message, update_fields=['render_version']), [])
+
+    def test_feed_and_unread(self):
+        message = self.post(GroupMessage, 'ping @bob', group=self.group)
+        client = api_client(self.bob)
+        feed = client.get('/api/chat/mentions/').data
+        self.assertEqual([m['message']['id'] for m in feed['mentions']], [message.pk])
+        self.assertEqual(client.get('/api/chat/mentions/unread/').data, {'total': 1, 'rooms': {f'group:{self.group.pk}': 1}})
+        self.assertEqual(client.post('/api/chat/mentions/read/', {}, format='json').data, {'marked_read': 1})
+
+        # Leaving the group hides its mentions
+        sharding.for_group(GroupChatroomMember, self.group.pk).filter(user=self.bob).update(is_active=False)
+        self.assertEqual(client.get('/api/chat/mentions/').data['mentions'], [])
+
+
+class GroupStatsTests(ChatTestCase):
+    """GroupStats and GroupActivity follow writes and feed the directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = UserProfile.objects.create_user('alice')
+        self.group = GroupChatroom.objects.create(name='room', created_by=self.user)
+        self.database = sharding.shard_for_group(self.group.pk)
+
+    def committed(self):
+        return self.captureOnCommitCallbacks(using=self.database, execute=True)
+
+    def post(self, content='hi'):
+        with self.committed():
+            return GroupMessage.objects.create(group=self.group, author=self.user, content=content)
+
+    def activity(self):
+        return list(GroupActivity.objects.filter(group=self.group).values_list('hour', 'message_count'))
+
+    def test_messages_and_members_are_counted(self):
+        with self.committed():
+            GroupChatroomMember.objects.create(group=self.group, user=self.user)
+        first, second = self.post(), self.post()
+        stats = GroupStats.objects.get(group=self.group)
+        self.assertEqual((stats.message_count, stats.member_count, stats.last_message_id), (2, 1, second.pk))
+        self.assertEqual(self.activity(), [(activity_hour(first.timestamp), 2)])
+
+    def test_deleting_messages_updates_stats_and_activity(self):
+        first, second = self.post(), self.post()
+        with self.committed():
+            second.delete()
+        stats = GroupStats.objects.get(group=self.group)
+        self.assertEqual((stats.message_count, stats.last_message_id, stats.last_message_at),
+                         (1, first.pk, first.timestamp))
+        self.assertEqual(self.activity(), [(activity_hour(first.timestamp), 1)])
+        with self.committed():
+            first.delete()
+        stats.refresh_from_db()
+        self.assertEqual((stats.message_count, stats.last_message_id, stats.last_message_at), (0, None, None))
+        self.assertEqual(self.activity(), [(activity_hour(first.timestamp), 0)])
+
+    def test_rebuild_matches_the_running_totals(self):
+        self.post(), self.post()
+        before = (GroupStats.objects.values().get(group=self.group), self.activity())
+        GroupStats.objects.filter(group=self.group).update(message_count=99)
+        GroupActivity.objects.filter(group=self.group).delete()
+        call_command('rebuild_group_stats', stdout=StringIO())
+        self.assertEqual((GroupStats.objects.values().get(group=self.group), self.activity()), before)
+
+    def test_directory(self):
+        quiet = GroupChatroom.objects.create(name='quiet', created_by=self.user)
+        self.post()
+        client = api_client(self.user)
+        response = client.get('/api/chat/groups/directory/', {'sort': 'trending'})
+        self.assertEqual([g['id'] for g in response.data['groups']], [self.group.pk, quiet.pk])
+        self.assertEqual(response.data['groups'][0]['message_count'], 1)
+        self.assertEqual(client.get('/api/chat/groups/directory/', {'sort': 'oldest'}).status_code, 400)
+
+
+class CompressionTests(ChatTestCase):
+    """CompressedTextField round trips and compress_messages"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = UserProfile.objects.create_user('alice')
+
+    def stored(self, message):
+        return PublicChatHistory.objects.values_list('content', flat=True).get(pk=message.pk)
+
+    def test_pack_round_trips(self):
+        long_text = 'héllo wörld, ' * 200
+        for text in ('', 'short', MARKER + 'looks packed', long_text, MARKER + long_text):
+            with self.subTest(text=text[:20]):
+                self.assertEqual(unpack(pack(text)), text)
+        self.assertEqual(pack('short'), 'short')
+        self.assertTrue(pack(long_text).startswith(MARKER))
+        self.assertLess(len(pack(long_text)), len(long_text))
+
+    def test_long_content_is_stored_compressed(self):
+        text = 'a fairly repetitive message ' * 100
+        message = PublicChatHistory.objects.create(author=self.user, content=text)
+        stored = self.stored(message)
+        self.assertIsInstance(stored, PackedText)
+        self.assertEqual(str(stored), text)
+        self.assertEqual(PublicChatHistory.objects.get(pk=message.pk).content, text)
+
+    def test_short_content_is_stored_plain(self):
+        message = PublicChatHistory.objects.create(author=self.user, content=MARKER + 'x')
+        self.assertEqual(PublicChatHistory.objects.get(pk=message.pk).content, MARKER + 'x')
+
+    def test_compress_messages_packs_existing_rows(self):
+        text = 'written before compression existed ' * 100
+        with override_settings(CHAT_COMPRESS_THRESHOLD=10 ** 9):
+            message = PublicChatHistory.objects.create(author=self.user, content=text)
+        self.assertEqual(self.stored(message), text)
+        call_command('compress_messages', stdout=StringIO())
+        self.assertIsInstance(self.stored(message), PackedText)
+        self.assertEqual(PublicChatHistory.objects.get(pk=message.pk).content, text)
+
+    def test_compress_messages_covers_group_messages_on_shards(self):
+        text = 'a group message on its shard ' * 100
+        group = GroupChatroom.objects.create(name='room', created_by=self.user)
+        with override_settings(CHAT_COMPRESS_THRESHOLD=10 ** 9):
+            message = GroupMessage.objects.create(group=group, author=self.user, content=text)
+        stored = sharding.for_group(GroupMessage, group.pk).filter(pk=message.pk).values_list('content', flat=True)
+        self.assertEqual(stored.get(), text)
+
+        out = StringIO()
+        call_command('compress_messages', stdout=out)
+        self.assertIsInstance(stored.get(), PackedText)
+        self.assertIn(f'GroupMessage@{message._state.db}: 1 rows compressed', out.getvalue())
+        self.assertEqual(sharding.for_group(GroupMessage, group.pk).get(pk=message.pk).content, text)
+
+
+class DownloadTests(ChatTestCase):
+    """Access checks and HTTP caching and range handling of attachment downloads"""
+    data = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        self.alice = UserProfile.objects.create_user('alice')
+        self.bob = UserProfile.objects.create_user('bob')
+        self.eve = UserProfile.objects.create_user('eve')
+        self.group = GroupChatroom.objects.create(name='room', created_by=self.alice)
+        for user in (self.alice, self.bob):
+            GroupChatroomMember.objects.create(group=self.group, user=user)
+        self.message = GroupMessage.objects.create(group=self.group, author=self.alice, content='file')
+        self.attachment = ChatFile(
+            original_name='report é.bin', file_size=len(self.data), file_type='application/octet-stream',
+            uploaded_by=self.alice, group_message=self.message
+        )
+        self.attachment.file.save('report.bin', ContentFile(self.data), save=False)
+        self.attachment.save()
+        self.url = f'/api/chat/files/{self.attachment.pk}/download/'
+        self.client = api_client(self.bob)
+
+    def body(self, response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_members_can_download(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+        self.assertEqual(response['Content-Disposition'], "attachment; filename*=utf-8''report%20%C3%A9.bin")
+
+    def test_others_get_not_found(self):
+        self.assertEqual(api_client(self.eve).get(self.url).status_code, 404)
+        self.assertEqual(self.client.get('/api/chat/files/999999/download/').status_code, 404)
+        self.assertEqual(APIClient().get(self.url).status_code, 401)
+
+    def test_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.content), (304, b''))
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_ranges(self):
+        size = len(self.data)
+        cases = [
+            ('bytes=10-19', 10, 19),
+            ('bytes=1000-', 1000, size - 1),
+            ('bytes=-5', size - 5, size - 1),
+            ('bytes=1000-99999', 1000, size - 1),
+        ]
+        for header, start, end in cases:
+            with self.subTest(header=header):
+                response = self.client.get(self.url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/{size}')
+                self.assertEqual(response['Content-Length'], str(end - start + 1))
+                self.assertEqual(self.body(response), self.data[start:end + 1])
+
+    def test_unsatisfiable_and_ignored_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+        # Multiple ranges and a stale If-Range get the whole file
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1,4-5').status_code, 200)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='"old"').status_code, 200)
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE=etag).status_code, 206)
+
+    def image(self, name, data):
+        image = ChatImage(original_name=name, file_size=len(data), uploaded_by=self.alice, group_message=self.message)
+        image.image.save(name, ContentFile(data), save=False)
+        image.save()
+        return self.client.get(f'/api/chat/images/{image.pk}/download/')
+
+    def test_only_raster_images_are_shown_inline(self):
+        response = self.image('photo.png', b'\x89PNG\r\n\x1a\n' + self.data)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response['Content-Disposition'].startswith('inline'))
+        self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+
+        for name in ('x.svg', 'x.html', 'x.png'):
+            with self.subTest(name=name):
+                response = self.image(name, b'<svg xmlns="http://www.w3.org/2000/svg" onload="alert(1)"/>')
+                self.assertEqual(response['Content-Type'], 'application/octet-stream')
+                self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+                self.assertEqual(response['Content-Security-Policy'], 'sandbox')
+
+    def test_head(self):
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+
+    def test_offload_to_the_proxy(self):
+        with override_settings(CHAT_DOWNLOAD_OFFLOAD='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/chat_files/report.bin')
+        self.assertEqual(response.content, b'')
+        with override_settings(CHAT_DOWNLOAD_OFFLOAD='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.attachment.file.path)
+
+
+class ProfileResolveTests(ChatTestCase):
+    """users/resolve/ and compact authors"""
+
+    def setUp(self):
+        super().setUp()
+        self.alice = UserProfile.objects.create_user('alice', display_name='Alice')
+        self.bob = UserProfile.objects.create_user('bob')
+        self.client = api_client(self.alice)
+
+    def resolve(self, ids):
+        return self.client.get('/api/chat/users/resolve/', {'ids': ids})
+
+    def test_resolve(self):
+        response = self.resolve(f'{self.alice.pk},{self.bob.pk},999999')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual({u['username'] for u in response.data['users']}, {'alice', 'bob'})
+        self.assertEqual(response.data['missing'], [999999])
+
+        version = next(u['version'] for u in response.data['users'] if u['id'] == self.alice.pk)
+        response = self.resolve(f'{self.alice.pk}:{version},{self.bob.pk}:1')
+        self.assertEqual(response.data['unchanged'], [self.alice.pk])
+        self.assertEqual([u['id'] for u in response.data['users']], [self.bob.pk])
+
+    def test_profile_changes_bump_the_version(self):
+        version = self.resolve(str(self.alice.pk)).data['users'][0]['version']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch('/api/chat/profile/update/', {'display_name': 'Al'}, format='json')
+        user = self.resolve(f'{self.alice.pk}:{version}').data['users'][0]
+        self.assertEqual(user['display_name'], 'Al')
+        self.assertGreater(user['version'], version)
+
+    def test_invalid_ids(self):
+        self.assertEqual(self.resolve('').status_code, 400)
+        self.assertEqual(self.resolve('x').status_code, 400)
+
+    def test_compact_authors(self):
+        message = PublicChatHistory.objects.create(author=self.bob, content='hi')
+        response = self.client.get('/api/chat/messages/poll/', {
+            'rooms': f'public:{message.pk - 1}', 'timeout': 0, 'authors': 'ids'
+        })
+        author = response.json()['rooms']['public'][0]['author']
+        self.assertEqual(set(author), {'id', 'version'})
+        self.assertEqual(author['id'], self.bob.pk)
+
+
+class ExportTests(ChatTestCase):
+    """NDJSON exports for staff"""
+
+    def setUp(self):
+        super().setUp()
+        self.staff = UserProfile.objects.create_user('admin', is_staff=True)
+        self.user = UserProfile.objects.create_user('bob')
+        self.messages = [PublicChatHistory.objects.create(author=self.user, content=f'm{n}') for n in range(3)]
+        PrivateMessage.objects.create(sender=self.user, receiver=self.staff, content='secret')
+        self.client = api_client(self.staff)
+
+    def export(self, **params):
+        return self.client.get('/api/chat/export/', params)
+
+    def test_room_export(self):
+        response = self.export(room='public')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        records = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([r['id'] for r in records], [m.pk for m in self.messages])
+        self.assertEqual({r['type'] for r in records}, {'public'})
+
+    def test_user_export_gzipped(self):
+        response = self.export(user=self.user.pk, compress='gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).splitlines()
+        self.assertEqual(sorted(json.loads(line)['content'] for line in lines), ['m0', 'm1', 'm2', 'secret'])
+
+    def test_requires_staff_and_one_target(self):
+        self.assertEqual(api_client(self.user).get('/api/chat/export/', {'room': 'public'}).status_code, 403)
+        self.assertEqual(self.export().status_code, 400)
+        self.assertEqual(self.export(room='public', user=self.user.pk).status_code, 400)
+
+
+class ImportUsersTests(ChatTestCase):
+    """import_users from CSV"""
+
+    def test_import(self):
+        UserProfile.objects.create_user('taken')
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('username,email,password,display_name\n')
+            f.write('new1,A@EXAMPLE.COM,pw-one,One\n')
+            f.write('new2,,,Two\n')
+            f.write('new1,,,Again\n')
+            f.write('taken,,,Taken\n')
+        self.addCleanup(os.remove, f.name)
+        call_command('import_users', f.name, workers=1, stdout=StringIO(), stderr=StringIO())
+
+        one, two = UserProfile.objects.filter(username__startswith='new').order_by('username')
+        self.assertTrue(one.check_password('pw-one'))
+        self.assertEqual((one.email, one.display_name), ('A@example.com', 'One'))
+        self.assertFalse(two.has_usable_password())
+        self.assertEqual(Token.objects.filter(user__in=[one, two]).count(), 2)
+        self.assertEqual(UserProfile.objects.filter(username='taken').count(), 1)
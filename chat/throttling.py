@@ -0,0 +1,125 @@
+"""
+Token-bucket flood control for message posting.
+
+Every post takes one token from the author's bucket (sized by their role in
+the room) and one from the room's bucket. Buckets live in process memory by
+default; the ``cache`` backend keeps them in Django's cache so that several
+workers share one budget, at the price of a cache round trip per check and
+slightly optimistic accounting under concurrent posts.
+"""
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def parse_rate(rate):
+    """Turn ``'20/min'`` into (capacity, tokens refilled per second)"""
+    num, period = rate.split('/')
+    seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return int(num), int(num) / seconds
+
+
+class LocalBucketStore:
+    """Buckets held in this process"""
+    max_entries = 100000
+    idle_seconds = 3600
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, capacity, refill, now):
+        """Take one token; return 0 on success or the seconds until one is available"""
+        with self._lock:
+            tokens, stamp = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - stamp) * refill)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / refill
+            if len(self._buckets) > self.max_entries:
+                self._prune(now)
+            return wait
+
+    def _prune(self, now):
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if now - bucket[1] < self.idle_seconds
+        }
+
+
+class CacheBucketStore:
+    """Buckets held in Django's default cache, shared by all workers"""
+    key_prefix = 'chat:flood:'
+
+    def take(self, key, capacity, refill, now):
+        cache_key = self.key_prefix + key
+        tokens, stamp = cache.get(cache_key, (capacity, now))
+        tokens = min(capacity, tokens + (now - stamp) * refill)
+        wait = 0 if tokens >= 1 else (1 - tokens) / refill
+        if not wait:
+            tokens -= 1
+        cache.set(cache_key, (tokens, now), timeout=int(capacity / refill) + 1)
+        return wait
+
+
+class FloodControl:
+    """Per-user and per-room posting limits, plus counters of who is being throttled"""
+    max_tracked = 10000
+
+    def __init__(self):
+        self._config = None
+        self._stats_lock = threading.Lock()
+        self.checked = 0
+        self.throttled = 0
+        self.throttled_users = Counter()
+        self.throttled_rooms = Counter()
+
+    @property
+    def config(self):
+        if self._config is None:
+            options = settings.CHAT_FLOOD_CONTROL
+            self._config = {
+                'store': CacheBucketStore() if options['BACKEND'] == 'cache' else LocalBucketStore(),
+                'user_rates': {role: parse_rate(rate) for role, rate in options['USER_RATES'].items()},
+                'room_rate': parse_rate(options['ROOM_RATE']),
+            }
+        return self._config
+
+    def check(self, user, room_key, role):
+        """Return None if ``user`` may post to ``room_key`` now, else seconds to wait"""
+        config = self.config
+        now = time.monotonic() if isinstance(config['store'], LocalBucketStore) else time.time()
+        capacity, refill = config['user_rates'].get(role, config['user_rates']['member'])
+        wait = config['store'].take(f'user:{user.pk}', capacity, refill, now)
+        if not wait:
+            capacity, refill = config['room_rate']
+            wait = config['store'].take(f'room:{room_key}', capacity, refill, now)
+        with self._stats_lock:
+            self.checked += 1
+            if wait:
+                self.throttled += 1
+                self.throttled_users[user.pk] += 1
+                self.throttled_rooms[room_key] += 1
+                if len(self.throttled_users) > self.max_tracked:
+                    self.throttled_users = Counter(dict(self.throttled_users.most_common(self.max_tracked // 10)))
+                if len(self.throttled_rooms) > self.max_tracked:
+                    self.throttled_rooms = Counter(dict(self.throttled_rooms.most_common(self.max_tracked // 10)))
+        return wait or None
+
+    def stats(self, top=20):
+        with self._stats_lock:
+            return {
+                'checked': self.checked,
+                'throttled': self.throttled,
+                'users': [{'user': pk, 'count': n} for pk, n in self.throttled_users.most_common(top)],
+                'rooms': [{'room': key, 'count': n} for key, n in self.throttled_rooms.most_common(top)],
+            }
+
+
+flood_control = FloodControl()
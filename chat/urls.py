@@ -10,4 +10,29 @@ urlpatterns = [
     # User profile endpoints
     path('profile/', views.user_profile, name='user_profile'),
     path('profile/update/', views.update_profile, name='update_profile'),
+    path('users/resolve/', views.resolve_users, name='resolve_users'),
+    
+    # Message endpoints
+    path('messages/poll/', views.poll_messages, name='poll_messages'),
+    path('messages/sync/', views.sync_conversations, name='sync_conversations'),
+    path('messages/throttled/', views.flood_control_stats, name='flood_control_stats'),
+    path('messages/<str:room>/', views.post_message, name='post_message'),
+    
+    # Attachment endpoints
+    path('files/<int:pk>/download/', views.download_attachment, {'kind': 'file'}, name='download_file'),
+    path('images/<int:pk>/download/', views.download_attachment, {'kind': 'image'}, name='download_image'),
+    
+    # Mention endpoints
+    path('mentions/', views.mentions_of_me, name='mentions_of_me'),
+    path('mentions/unread/', views.unread_mentions, name='unread_mentions'),
+    path('mentions/read/', views.mark_mentions_read, name='mark_mentions_read'),
+    
+    # Group endpoints
+    path('groups/directory/', views.group_directory, name='group_directory'),
+    
+    # Compliance endpoints
+    path('export/', views.export_history, name='export_history'),
+    
+    # Monitoring endpoints
+    path('metrics/', views.metrics, name='metrics'),
 ]
@@ -1,10 +1,37 @@
-from rest_framework import status, permissions
+from asgiref.sync import sync_to_async
+from rest_framework import status, permissions, exceptions
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
+from datetime import timedelta
+import math
+
+from django.conf import settings
 from django.contrib.auth import authenticate
-from .serializers import UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer
-from .models import UserProfile
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+from .serializers import (
+    UserRegistrationSerializer, UserLoginSerializer, UserProfileSerializer,
+    GroupChatroomMemberSerializer, GroupDirectorySerializer, MentionSerializer, SyncRequestSerializer
+)
+from .models import UserProfile, GroupChatroom, GroupChatroomMember
+from .conversations import (
+    Conversation, InvalidConversation, available_conversations, conversation_role, resolve_conversations
+)
+from .downloads import can_access, find_attachment, serve
+from .exports import export_stream, validate_export_target
+from .mentions import attach_messages, visible_mentions
+from .metrics import exposition, registry
+from .notifications import notifier
+from .profiles import author_ids, profile_versions, resolve_profiles
+from .sharding import GroupMoving, check_writable, fan_out
+from .throttling import flood_control
 
 
 @api_view(['POST'])
@@ -87,3 +114,436 @@ def update_profile(request):
             'user': serializer.data
         }, status=status.HTTP_200_OK)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def resolve_users(request):
+    """
+    Public profiles of several users in one call, from the shared profile cache.
+
+    ``?ids=3,8:1760870400123456`` lists user ids, each optionally with the
+    profile version the client already has; users still at that version are
+    only listed under ``unchanged``.
+    """
+    known = {}
+    try:
+        for item in filter(None, request.GET.get('ids', '').split(',')):
+            user_id, _, version = item.partition(':')
+            known[int(user_id)] = int(version) if version else None
+    except ValueError:
+        return Response({'error': 'ids must look like 3,8:<version>'}, status=status.HTTP_400_BAD_REQUEST)
+    if not known:
+        return Response({'error': 'At least one user id is required'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(known) > settings.CHAT_RESOLVE_MAX_IDS:
+        return Response({'error': f'At most {settings.CHAT_RESOLVE_MAX_IDS} users per request'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    versions = profile_versions(known)
+    unchanged = [user_id for user_id, version in versions.items() if known[user_id] == version]
+    profiles = resolve_profiles(versions.keys() - set(unchanged))
+    return Response({
+        'users': list(profiles.values()),
+        'unchanged': sorted(unchanged),
+        'missing': sorted(known.keys() - versions.keys()),
+    }, status=status.HTTP_200_OK)
+
+
+def _token_user(request):
+    try:
+        result = TokenAuthentication().authenticate(request)
+    except exceptions.AuthenticationFailed:
+        return None
+    return result[0] if result else None
+
+
+async def _authenticate(request):
+    """Token or session authentication for async views, which bypass DRF"""
+    user = await sync_to_async(_token_user)(request)
+    if user is None:
+        user = await request.auser()
+    return user if user.is_authenticated else None
+
+
+def _parse_cursors(value):
+    """Parse ``public:120,group:5:88`` into {'public': 120, 'group:5': 88}"""
+    cursors = {}
+    for item in filter(None, value.split(',')):
+        key, _, after_id = item.rpartition(':')
+        if not key or not after_id.isdigit():
+            raise InvalidConversation(f"Invalid cursor '{item}'")
+        cursors[Conversation.parse(key).key] = int(after_id)
+    if not cursors:
+        raise InvalidConversation('At least one room is required')
+    return cursors
+
+
+def _compact_authors(request):
+    """``?authors=ids`` asks for authors as ids and profile versions only"""
+    return request.GET.get('authors') == 'ids'
+
+
+def _author_context(compact, *message_lists):
+    if not compact:
+        return {}
+    return {'author_versions': profile_versions(
+        author_ids(message for messages in message_lists for message in messages)
+    )}
+
+
+def _collect_new_messages(user, conversations, cursors, compact=False):
+    limit = settings.CHAT_LONG_POLL_BATCH_SIZE
+    rooms = {}
+    for key, conversation in conversations.items():
+        messages = list(conversation.messages_after(user, cursors[key], authors=not compact)[:limit])
+        if messages:
+            rooms[key] = conversation.serializer_class(
+                messages, many=True, context=_author_context(compact, messages)
+            ).data
+    return rooms
+
+
+@require_GET
+async def poll_messages(request):
+    """
+    Long-poll for new messages in one or more rooms.
+
+    ``rooms`` is a comma separated list of ``<room>:<last seen message id>``,
+    e.g. ``?rooms=public:120,group:5:88,private:7:10``. Returns as soon as any
+    of the rooms has newer messages, or with an empty result after ``timeout``
+    seconds. Serve through ASGI so parked requests do not hold a worker thread.
+    ``?authors=ids`` sends authors as ids and profile versions.
+    """
+    user = await _authenticate(request)
+    if user is None:
+        return JsonResponse({
+            'detail': 'Authentication credentials were not provided.'
+        }, status=status.HTTP_401_UNAUTHORIZED)
+
+    try:
+        cursors = _parse_cursors(request.GET.get('rooms', ''))
+        timeout = float(request.GET.get('timeout', settings.CHAT_LONG_POLL_TIMEOUT))
+        if not math.isfinite(timeout):
+            raise ValueError('timeout must be a finite number of seconds')
+        conversations = await sync_to_async(resolve_conversations)(user, cursors)
+    except (InvalidConversation, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except PermissionDenied as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_403_FORBIDDEN)
+    timeout = min(max(timeout, 0), settings.CHAT_LONG_POLL_MAX_TIMEOUT)
+
+    channels = {conversation.channel(user): key for key, conversation in conversations.items()}
+    # Subscribe before the first query so a write landing in between still wakes us
+    with notifier.subscribe(channels) as subscription:
+        compact = _compact_authors(request)
+        rooms = await sync_to_async(_collect_new_messages)(user, conversations, cursors, compact)
+        if not rooms and timeout:
+            fired = await subscription.wait(timeout)
+            if fired:
+                woken = {channels[c]: conversations[channels[c]] for c in fired}
+                rooms = await sync_to_async(_collect_new_messages)(user, woken, cursors, compact)
+
+    return JsonResponse({
+        'rooms': rooms,
+        'cursors': {
+            key: messages[-1]['id'] if (messages := rooms.get(key)) else after_id
+            for key, after_id in cursors.items()
+        },
+    })
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def sync_conversations(request):
+    """
+    Delta sync for several conversations in one round trip.
+
+    Body: ``{"since": <time>, "conversations": {"group:5": {"after": 88}, ...}}``
+    where ``after`` is the last seen message id and ``since`` (global or per
+    conversation) the ``server_time`` of the previous sync. Returns new
+    messages, edits to already-seen messages and group membership changes.
+    ``?authors=ids`` sends authors as ids and profile versions.
+
+    Both lists are capped at CHAT_SYNC_BATCH_SIZE. With ``has_more`` the
+    client continues from the last message id; with ``edited_has_more`` it
+    sends the conversation's ``edited_cursor`` (``since`` and
+    ``edited_after``) next time instead of moving it to ``server_time``.
+    Rooms the user can no longer read are listed under ``unavailable``.
+    """
+    serializer = SyncRequestSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    # Taken before querying so nothing written during the sync is skipped next time
+    server_time = timezone.now()
+    since = serializer.validated_data.get('since')
+    try:
+        cursors = {
+            Conversation.parse(key).key: cursor
+            for key, cursor in serializer.validated_data['conversations'].items()
+        }
+        conversations, unavailable = available_conversations(request.user, cursors)
+    except InvalidConversation as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    limit = settings.CHAT_SYNC_BATCH_SIZE
+    compact = _compact_authors(request)
+    results = {}
+    for key, conversation in conversations.items():
+        after = cursors[key]['after']
+        conversation_since = cursors[key].get('since') or since
+        messages = list(conversation.messages_after(request.user, after, authors=not compact)[:limit + 1])
+        edited = []
+        if conversation_since:
+            edited = list(conversation.edited_since(
+                request.user, conversation_since, after,
+                after_id=cursors[key].get('edited_after') if cursors[key].get('since') else None,
+                authors=not compact
+            )[:limit + 1])
+        context = _author_context(compact, messages[:limit], edited[:limit])
+        result = {
+            'messages': conversation.serializer_class(messages[:limit], many=True, context=context).data,
+            'has_more': len(messages) > limit,
+        }
+        if conversation_since:
+            result['edited'] = conversation.serializer_class(edited[:limit], many=True, context=context).data
+            result['edited_has_more'] = len(edited) > limit
+            if result['edited_has_more']:
+                last = edited[limit - 1]
+                result['edited_cursor'] = {'since': last.edited_at, 'edited_after': last.pk}
+            if conversation.kind == 'group':
+                members = conversation.membership_changes(conversation_since)
+                result['members'] = GroupChatroomMemberSerializer(members, many=True).data
+        results[key] = result
+
+    memberships = []
+    if since:
+        changed = GroupChatroomMember.objects.filter(
+            user=request.user, updated_at__gt=since
+        ).prefetch_related('user')
+        memberships = GroupChatroomMemberSerializer(
+            [member for queryset in fan_out(changed) for member in queryset],
+            many=True
+        ).data
+
+    return Response({
+        'server_time': server_time,
+        'conversations': results,
+        'unavailable': {key: str(e) for key, e in unavailable.items()},
+        'memberships': memberships,
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def post_message(request, room):
+    """
+    Post a message to a room (``public``, ``group:<id>`` or ``private:<user id>``)
+    """
+    try:
+        conversation = Conversation.parse(room)
+        role = conversation_role(request.user, conversation)
+        if conversation.kind == 'group':
+            check_writable(conversation.target_id)
+    except InvalidConversation as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except PermissionDenied as e:
+        return Response({'error': str(e)}, status=status.HTTP_403_FORBIDDEN)
+    except GroupMoving as e:
+        return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': '10'})
+
+    wait = flood_control.check(request.user, conversation.key, role)
+    if wait is not None:
+        raise exceptions.Throttled(wait)
+
+    serializer = conversation.serializer_class(data=request.data)
+    # Replies must stay inside the conversation (and on its shard)
+    serializer.fields['reply_to'].queryset = conversation.messages(request.user)
+    if serializer.is_valid():
+        serializer.save(**conversation.save_kwargs(request.user))
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+DIRECTORY_ORDERING = {
+    'active': [F('stats__last_message_at').desc(nulls_last=True)],
+    'messages': [F('stats__message_count').desc(nulls_last=True)],
+    'members': [F('stats__member_count').desc(nulls_last=True)],
+    'trending': ['-recent_messages', F('stats__last_message_at').desc(nulls_last=True)],
+}
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def group_directory(request):
+    """
+    Public rooms sorted by ``?sort=active`` (last message, the default),
+    ``messages``, ``members`` or ``trending`` (messages in the last
+    CHAT_TRENDING_HOURS). Reads only the GroupStats rollups, never the messages.
+    """
+    sort = request.GET.get('sort', 'active')
+    if sort not in DIRECTORY_ORDERING:
+        return Response({'error': f"sort must be one of {', '.join(DIRECTORY_ORDERING)}"},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        limit = int(request.GET.get('limit', settings.CHAT_DIRECTORY_PAGE_SIZE))
+    except ValueError:
+        return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = min(max(limit, 1), settings.CHAT_DIRECTORY_MAX_PAGE_SIZE)
+
+    groups = GroupChatroom.objects.filter(is_active=True, is_private=False).annotate(
+        message_count=Coalesce('stats__message_count', 0),
+        member_count=Coalesce('stats__member_count', 0),
+        last_message_at=F('stats__last_message_at'),
+    )
+    if sort == 'trending':
+        since = timezone.now() - timedelta(hours=settings.CHAT_TRENDING_HOURS)
+        groups = groups.annotate(recent_messages=Coalesce(
+            Sum('activity__message_count', filter=Q(activity__hour__gte=since)), 0
+        ))
+    groups = groups.order_by(*DIRECTORY_ORDERING[sort], 'pk')[:limit]
+    return Response({
+        'sort': sort,
+        'groups': GroupDirectorySerializer(groups, many=True).data,
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def mentions_of_me(request):
+    """
+    Messages mentioning the current user, newest first. Page with
+    ``?before=<id of the last mention seen>`` and ``?limit=``;
+    ``?authors=ids`` sends authors as ids and profile versions.
+    """
+    try:
+        before = int(request.GET['before']) if 'before' in request.GET else None
+        limit = int(request.GET.get('limit', settings.CHAT_MENTIONS_PAGE_SIZE))
+    except ValueError:
+        return Response({'error': 'before and limit must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+    limit = min(max(limit, 1), settings.CHAT_MENTIONS_MAX_PAGE_SIZE)
+
+    mentions = visible_mentions(request.user).order_by('-id')
+    if before is not None:
+        mentions = mentions.filter(id__lt=before)
+    compact = _compact_authors(request)
+    fetched = list(mentions[:limit + 1])
+    page = attach_messages(fetched[:limit], authors=not compact)
+    context = _author_context(compact, [m.message for m in page if m.message is not None])
+    return Response({
+        'mentions': MentionSerializer(page, many=True, context=context).data,
+        'has_more': len(fetched) > limit,
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def unread_mentions(request):
+    """
+    Number of unread mentions of the current user, in total and per room
+    """
+    rooms = {
+        f'group:{row["group_id"]}' if row['group_id'] else 'public': row['count']
+        for row in visible_mentions(request.user).filter(is_read=False).values('group_id').annotate(
+            count=Count('id')
+        ).order_by()
+    }
+    return Response({'total': sum(rooms.values()), 'rooms': rooms}, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def mark_mentions_read(request):
+    """
+    Mark the current user's mentions read, up to and including mention id
+    ``up_to`` if given (optionally only in ``room``), otherwise all of them
+    """
+    mentions = request.user.mentions.filter(is_read=False)
+    try:
+        if request.data.get('up_to') is not None:
+            mentions = mentions.filter(id__lte=int(request.data['up_to']))
+        if request.data.get('room'):
+            conversation = Conversation.parse(str(request.data['room']))
+            if conversation.kind == 'private':
+                raise InvalidConversation('Private messages have no mentions')
+            mentions = mentions.filter(group_id=conversation.target_id)
+    except (InvalidConversation, TypeError, ValueError) as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return Response({'marked_read': mentions.update(is_read=True)}, status=status.HTTP_200_OK)
+
+
+@api_view(['GET', 'HEAD'])
+@permission_classes([permissions.IsAuthenticated])
+def download_attachment(request, kind, pk):
+    """
+    Download a shared file or image if the user can read the message it was
+    shared in. Supports Range and If-None-Match; see chat/downloads.py.
+    """
+    try:
+        attachment = find_attachment(kind, pk)
+    except ObjectDoesNotExist:
+        attachment = None
+    # 404 rather than 403 so ids of attachments the user cannot see stay hidden
+    if attachment is None or not can_access(request.user, attachment):
+        return Response({'error': 'Not found'}, status=status.HTTP_404_NOT_FOUND)
+    return serve(request, attachment)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def flood_control_stats(request):
+    """
+    Posting attempts checked and throttled by this process, with the top offenders
+    """
+    return Response(flood_control.stats())
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def export_history(request):
+    """
+    Stream the full history of a user (``?user=<id>``) or a room
+    (``?room=public`` or ``?room=group:<id>``) as NDJSON, gzipped with
+    ``?compress=gzip``
+    """
+    user_id = request.query_params.get('user')
+    room = request.query_params.get('room')
+    compress = request.query_params.get('compress') == 'gzip'
+    try:
+        if user_id is not None:
+            user_id = int(user_id)
+        validate_export_target(user_id=user_id, room=room)
+    except (InvalidConversation, ValueError) as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    filename = f"user-{user_id}" if user_id is not None else room.replace(':', '-')
+    filename += '.ndjson.gz' if compress else '.ndjson'
+    response = StreamingHttpResponse(
+        export_stream(user_id=user_id, room=room, compress=compress),
+        content_type='application/gzip' if compress else 'application/x-ndjson'
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _may_scrape(request):
+    """``Authorization: Bearer <CHAT_METRICS_TOKEN>``, or a staff user's token or session"""
+    token = settings.CHAT_METRICS_TOKEN
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    user = _token_user(request) or request.user
+    return user.is_authenticated and user.is_staff
+
+
+@require_GET
+def metrics(request):
+    """
+    Request, long-poll and flood control metrics of every worker in the
+    Prometheus text format, for the CHAT_METRICS_TOKEN bearer token or staff.
+    """
+    if not _may_scrape(request):
+        return HttpResponseForbidden('Metrics require CHAT_METRICS_TOKEN or a staff account\n')
+    return HttpResponse(
+        exposition(registry.collect()),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )